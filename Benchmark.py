@@ -0,0 +1,210 @@
+"""
+各阶段的性能测试，会自动生成指定大小和物体密度的图片与labelme json，不需要真实数据
+用法: python Benchmark.py --height 2048 --width 2048 --instances 800 --output result.json
+结果为json，包含每个阶段的耗时(取多次运行的中位数)、吞吐量、内存峰值和写入的字节数
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+import cv2
+import numpy
+
+from Cache import DecodeCache
+from DataAug import AUG_BACKENDS, aug_data, iter_aug_data
+from DataObj import PATCH_MODES, ImageData, Patch
+from Metrics import get_max_rss
+from Pipeline import seed_everything
+from Writer import AsyncWriter
+
+
+def make_sample(folder: str, name: str, shape: tuple, instances: int, seed: int = 0):
+    """
+    生成一张随机纹理的图片和同名的labelme json，物体是随机大小的不规则多边形
+    :param shape: 图片的(高度, 长度)
+    :param instances: 物体数量，类型随机为h、l、n之一
+    """
+    rng = random.Random(seed)
+    image = numpy.random.RandomState(seed).randint(0, 256, (shape[0], shape[1], 3), dtype="uint8")
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    shapes = []
+    for _ in range(instances):
+        center_x, center_y = rng.uniform(0, shape[1]), rng.uniform(0, shape[0])
+        radius = rng.uniform(6, 24)
+        count = rng.randint(8, 16)
+        points = []
+        for i in range(count):
+            angle = 2 * math.pi * i / count
+            cur_radius = radius * rng.uniform(0.7, 1.0)
+            points.append([center_x + cur_radius * math.cos(angle), center_y + cur_radius * math.sin(angle)])
+        # 同时把物体画到图片上，让贴图和无缝贴图有真实的内容
+        cv2.fillPoly(image, [numpy.array(points, "int32")], (rng.randint(0, 255),) * 3)
+        shapes.append({"label": rng.choice("hln"), "points": points})
+    cv2.imwrite(path.join(folder, name + ".png"), image)
+    with open(path.join(folder, name + ".json"), mode="w") as file:
+        json.dump({"shapes": shapes, "imageHeight": shape[0], "imageWidth": shape[1]}, file)
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """
+    运行repeat次func并计时，再单独运行一次用tracemalloc记录内存峰值（避免影响计时）
+    :param setup: 每次运行前调用，返回值作为func的参数，不计入耗时
+    """
+    runs = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        runs.append(time.perf_counter() - start)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    func(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": statistics.median(runs), "runs": runs, "peak_traced_bytes": peak}
+
+
+def run(args) -> dict:
+    work_path = tempfile.mkdtemp(prefix="benchmark_")
+    source_path = path.join(work_path, "source")
+    os.makedirs(source_path)
+    try:
+        make_sample(source_path, "sample", (args.height, args.width), args.instances, args.seed)
+        seed_everything(args.seed)
+        stages = dict()
+        megapixels = args.height * args.width / 1e6
+
+        def add(stage: str, result: dict, items: int, pixels: float):
+            result["items"] = items
+            result["items_per_second"] = items / result["seconds"] if result["seconds"] else None
+            result["megapixels_per_second"] = pixels / result["seconds"] if result["seconds"] else None
+            stages[stage] = result
+            print(f"{stage}: {result['seconds'] * 1000:.1f}ms", file=sys.stderr)
+
+        add("decode", measure(lambda _: ImageData.create_from_file("sample.png", source_path), args.repeat),
+            1, megapixels)
+        data = ImageData.create_from_file("sample.png", source_path)
+        mask_count = data.mask_count
+
+        def polygon_data():
+            # 还没有栅格化的数据，用于栅格化和多边形形式的SPLIT
+            return ImageData(data.name, data.image, data.mask_polygons)
+
+        add("rasterize", measure(lambda cur: cur.convert_polygons_to_images(), args.repeat, polygon_data),
+            mask_count, megapixels)
+        add("label_map_polygon", measure(lambda cur: cur.get_label_maps({"h": 1, "l": 2, "n": 3}), args.repeat,
+                                         polygon_data), mask_count, megapixels)
+        data.convert_polygons_to_images()
+
+        add("aug", measure(lambda _: aug_data(data), args.repeat), 4, megapixels * 4)
+        add("aug_fused", measure(lambda _: aug_data(data, "FUSED"), args.repeat), 4, megapixels * 4)
+        for backend in AUG_BACKENDS:
+            add(f"aug_{backend.lower()}_threads", measure(
+                lambda _, backend=backend: list(iter_aug_data(data, backend, args.aug_threads)), args.repeat),
+                4, megapixels * 4)
+        add("split", measure(lambda _: data.split(args.split), args.repeat),
+            len(data.split(args.split)), megapixels)
+        add("split_polygon", measure(lambda _: polygon_data().split(args.split, clip_polygons=True), args.repeat),
+            len(polygon_data().split(args.split, clip_polygons=True)), megapixels)
+        cache = DecodeCache(path.join(work_path, "cache"), 1 << 40)
+        cache.open_image("sample.png", source_path)
+
+        def split_windowed(_):
+            # 每一块生成mask后立刻丢弃，内存峰值只与块的大小有关
+            for tile in ImageData.open_from_file("sample.png", source_path, cache).iter_split(args.split,
+                                                                                             clip_polygons=True):
+                tile.mask_images
+        add("split_windowed", measure(split_windowed, args.repeat),
+            len(polygon_data().split(args.split, clip_polygons=True)), megapixels)
+        add("patch_create", measure(lambda _: Patch.create_from_image_data(data, args.patch_size), args.repeat),
+            len(Patch.create_from_image_data(data, args.patch_size)), megapixels)
+
+        add("patch_create_object",
+            measure(lambda _: Patch.create_from_objects(data, args.patch_size), args.repeat),
+            len(Patch.create_from_objects(data, args.patch_size)), megapixels)
+
+        # 贴图：每次运行把patch_amount个Patch贴到第一块上
+        tiles = data.split(args.split)
+        patches = [i for i in Patch.create_from_image_data(data, args.patch_size)
+                   if i.shape[0] <= tiles[0].shape[0] and i.shape[1] <= tiles[0].shape[1]]
+        if patches:
+            cur_patches = [patches[i % len(patches)] for i in range(args.patch_amount)]
+            tile_pixels = tiles[0].shape[0] * tiles[0].shape[1] / 1e6 * args.patch_amount
+            for mode in PATCH_MODES:
+                def apply(_, mode=mode):
+                    cur = tiles[0]
+                    for patch in cur_patches:
+                        cur = patch.apply_to_image_data(cur, mode=mode)
+                add(f"patch_apply_{mode.lower()}", measure(apply, args.repeat), args.patch_amount, tile_pixels)
+
+                def apply_batch(_, mode=mode):
+                    Patch.apply_patches_to_image_data(tiles[0], cur_patches, mode=mode)
+                add(f"patch_batch_{mode.lower()}", measure(apply_batch, args.repeat), args.patch_amount, tile_pixels)
+
+        # 导出：每次运行导出到一个新的空文件夹
+        for output_format in ("MASKS", "LABELMAP", "NPZ"):
+            written = []
+
+            def export(target_path, output_format=output_format):
+                with AsyncWriter(args.writer_threads, compression=args.png_compression) as writer:
+                    for tile in tiles:
+                        tile.dump(target_path, output_format, {"h": 1, "l": 2, "n": 3}, writer)
+                written.append((writer.files_written, writer.bytes_written))
+
+            result = measure(export, args.repeat, lambda: tempfile.mkdtemp(dir=work_path))
+            result["files_written"], result["bytes_written"] = written[-1]
+            add(f"export_{output_format.lower()}", result, len(tiles), megapixels)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    return {
+        "config": {key: list(value) if isinstance(value, tuple) else value for key, value in vars(args).items()},
+        "sample": {"mask_count": mask_count, "megapixels": megapixels},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": stages,
+        "max_rss_bytes": get_max_rss(),
+    }
+
+
+def parse_size(text: str) -> tuple:
+    """把"高度,长度"转换为tuple"""
+    return tuple(int(i) for i in text.split(","))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="数据增强各阶段的性能测试")
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--instances", type=int, default=300, help="图片中物体的数量")
+    parser.add_argument("--split", type=parse_size, default=(384, 512), help="分割大小，格式为 高度,长度")
+    parser.add_argument("--patch-size", type=parse_size, default=(128, 128), help="Patch大小，格式为 高度,长度")
+    parser.add_argument("--patch-amount", type=int, default=2)
+    parser.add_argument("--writer-threads", type=int, default=4)
+    parser.add_argument("--aug-threads", type=int, default=4, help="同时运行的增强序列数")
+    parser.add_argument("--png-compression", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段运行的次数，取中位数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="结果json的保存路径，不填写则输出到屏幕")
+    args = parser.parse_args()
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, mode="w") as output_file:
+            output_file.write(result)
+    else:
+        print(result)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import zipfile
+from os import path
+
+import cv2
+import numpy
+
+from DataObj import ImageData
+from Manifest import get_file_hash
+from Utils import encode_npz, get_json_name, get_masks_from_json, get_sample_name, open_image
+
+# 解码或栅格化的方式改变时需要增加，使旧的缓存失效
+CACHE_VERSION = 2
+
+
+class DecodeCache:
+    """
+    把解码后的图片和栅格化后的mask缓存到磁盘上，以源图片和json的内容作为键
+    rasterize为False时(多边形模式)只缓存图片和多边形，mask在需要时才栅格化
+    按窗口读取时(open_image)只缓存未压缩的图片(.npy)，以源图片的内容作为键
+    缓存的总大小超过max_bytes时，删除最久没有使用的缓存
+    多个进程可以同时使用同一个缓存文件夹
+    """
+
+    def __init__(self, cache_path: str, max_bytes: int, rasterize: bool = True):
+        """
+        :param rasterize: 是否同时缓存栅格化后的mask，之后只裁剪多边形(POLYGON_MODE)时不需要
+        """
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.rasterize = rasterize
+        os.makedirs(cache_path, exist_ok=True)
+
+    def get_key(self, image_bytes: bytes, json_bytes: bytes) -> str:
+        # 两种缓存的内容不同，不能共用
+        hasher = hashlib.sha256(f"{CACHE_VERSION}:{'masks' if self.rasterize else 'polygons'}:".encode("utf-8"))
+        hasher.update(image_bytes)
+        hasher.update(json_bytes)
+        return hasher.hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return path.join(self.cache_path, key + ".npz")
+
+    def load(self, key: str, name: str) -> ImageData | None:
+        """读取缓存，不存在时返回None"""
+        file_path = self._get_path(key)
+        try:
+            data = ImageData.create_from_npz(file_path) if self.rasterize else self._load_polygons(file_path)
+            # 更新修改时间，用于判断最近是否使用过
+            os.utime(file_path)
+        except (FileNotFoundError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # 不存在、已经被其它进程删除或者没有写完整
+            return None
+        data.name = name
+        return data
+
+    @staticmethod
+    def _load_polygons(file_path: str) -> ImageData:
+        """读取只有图片和多边形的缓存，mask保持未栅格化"""
+        with numpy.load(file_path) as npz:
+            return ImageData(path.basename(file_path)[:-4], npz["image"], json.loads(str(npz["polygons"])))
+
+    def save(self, key: str, data: ImageData):
+        # 不需要mask时只保存图片，保存时也就不需要栅格化
+        arrays = data.get_npz_arrays() if self.rasterize else {"image": data.image}
+        arrays["polygons"] = numpy.array(json.dumps(data.mask_polygons))
+        # 先写入临时文件再改名，防止其它进程读到没写完的文件
+        temp_path = self._get_path(key) + f".{os.getpid()}.tmp"
+        with open(temp_path, mode="wb") as file:
+            file.write(encode_npz(arrays, compressed=False))
+        os.replace(temp_path, self._get_path(key))
+        self.evict()
+
+    def evict(self):
+        """删除最久没有使用的缓存，直到总大小不超过max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_path):
+            if not name.endswith((".npz", ".npy")):
+                continue
+            try:
+                stat = os.stat(path.join(self.cache_path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path.join(self.cache_path, name))
+            except OSError:
+                # 已经被其它进程删除，或者在Windows下正在被映射
+                pass
+            total -= size
+
+    def create_image_data(self, file_name: str, source_path: str) -> ImageData:
+        """与ImageData.create_from_file相同，但是会优先使用缓存"""
+        with open(path.join(source_path, file_name), mode="rb") as file:
+            image_bytes = file.read()
+        with open(path.join(source_path, get_json_name(file_name)), mode="rb") as file:
+            json_bytes = file.read()
+        key = self.get_key(image_bytes, json_bytes)
+        data = self.load(key, get_sample_name(file_name))
+        if data is None:
+            image = cv2.imdecode(numpy.frombuffer(image_bytes, dtype="uint8"), cv2.IMREAD_COLOR)
+            masks = get_masks_from_json(json.loads(json_bytes.decode("utf-8")))
+            data = ImageData(get_sample_name(file_name), image, masks)
+            self.save(key, data)
+        return data
+
+    def open_image(self, file_name: str, source_path: str) -> numpy.ndarray:
+        """与Utils.open_image相同，解码后的图片保存在缓存中，之后每次打开都只需要映射"""
+        file_path = path.join(source_path, file_name)
+        hasher = get_file_hash(file_path, hashlib.sha256(f"{CACHE_VERSION}:raw:".encode("utf-8")))
+        raw_path = path.join(self.cache_path, hasher.hexdigest() + ".npy")
+        exists = path.exists(raw_path)
+        image = open_image(file_path, raw_path)
+        if not exists:
+            self.evict()
+            return image
+        try:
+            # 更新修改时间，用于判断最近是否使用过
+            os.utime(raw_path)
+        except FileNotFoundError:
+            pass
+        return image
@@ -1,7 +1,18 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+
 import imgaug as ia
 import imgaug.augmenters as iaa
+import numpy
 
 import DataObj
+from FusedAug import get_fused_seqs
+from Utils import pack_polygons
+
+# IMGAUG: 使用get_aug_seqs中的imgaug序列
+# FUSED: 使用FusedAug中对应的快速实现，结果在统计上相同，但与IMGAUG不会逐像素相同
+AUG_BACKENDS = ("IMGAUG", "FUSED")
 
 '''
 def get_aug_seqs() -> list:
@@ -165,19 +176,140 @@ def get_aug_seqs() -> list:
 
 
 augs = get_aug_seqs()  # 为了防止重新生成aug_seqs
+fused_augs = get_fused_seqs()
+
+
+def _flatten_polygons(data: DataObj.ImageData) -> tuple:
+    """
+    把所有类型的多边形合并到一个列表中，这样所有类型只需要增强一次
+    :return: (类型列表, 每个类型的多边形数量, 合并后的ia.Polygon列表)
+    """
+    types = list(data.mask_polygons.keys())
+    counts = []
+    polygons = []
+    for cur_type in types:
+        polygons += [ia.Polygon(mask) for mask in data.mask_polygons[cur_type]]
+        counts.append(len(data.mask_polygons[cur_type]))
+    return types, counts, polygons
+
+
+def _restore_polygons(types: list, counts: list, polygons: list) -> dict:
+    """_flatten_polygons的逆操作，同时把多边形转回坐标"""
+    result = dict()
+    start = 0
+    for cur_type, count in zip(types, counts):
+        result[cur_type] = [i.coords for i in polygons[start:start + count]]
+        start += count
+    return result
+
+
+def _create_aug_data(data: DataObj.ImageData, aug_cnt: int, image, polygons: dict) -> DataObj.ImageData:
+    new_data = DataObj.ImageData(data.name + f"_aug[{aug_cnt}]", image, polygons)
+    new_data.lineage = data.lineage + [{"stage": "aug", "index": aug_cnt}]
+    return new_data
+
+
+_pools = dict()  # (进程号, 线程数) -> 线程池，fork出的子进程不能使用父进程的线程池
+
 
+def _get_pool(threads: int) -> ThreadPoolExecutor:
+    key = (os.getpid(), threads)
+    if key not in _pools:
+        _pools[key] = ThreadPoolExecutor(threads)
+    return _pools[key]
 
-def aug_data(data: DataObj.ImageData) -> list:
-    result = []
+
+def _get_seeds() -> list:
+    """每个增强序列使用自己的随机种子，由当前的全局随机状态生成，所以结果与运行的线程和顺序无关"""
+    return numpy.random.randint(0, 2 ** 31, len(augs)).tolist()
+
+
+def plan_aug(data: DataObj.ImageData, backend: str = "IMGAUG") -> list:
+    """
+    准备data的所有增强序列，多边形只转换一次(ia.Polygon或者一个点的数组)，所有序列共用
+    :return: 与增强序列顺序相同的函数列表，调用后返回该序列的结果，可以在不同线程中同时调用
+    """
+    seeds = _get_seeds()
+    if backend == "FUSED":
+        types = list(data.mask_polygons.keys())
+        counts = [len(data.mask_polygons[cur_type]) for cur_type in types]
+        points, starts, _ = pack_polygons([mask for cur_type in types for mask in data.mask_polygons[cur_type]])
+        starts = starts.tolist()
+
+        def run(aug_cnt: int) -> DataObj.ImageData:
+            aug = fused_augs[aug_cnt - 1]
+            image_aug, points_aug = aug(data.image, points, numpy.random.RandomState(seeds[aug_cnt - 1]))
+            polygons = dict()
+            index = 0
+            for cur_type, count in zip(types, counts):
+                polygons[cur_type] = [points_aug[starts[i]:starts[i + 1]] for i in range(index, index + count)]
+                index += count
+            return _create_aug_data(data, aug_cnt, image_aug, polygons)
+    else:
+        types, counts, polygons = _flatten_polygons(data)
+
+        def run(aug_cnt: int) -> DataObj.ImageData:
+            aug = augs[aug_cnt - 1]
+            aug.seed_(seeds[aug_cnt - 1])
+            image_aug, polygons_aug = aug(image=data.image, polygons=polygons)
+            assert image_aug is not None
+            return _create_aug_data(data, aug_cnt, image_aug, _restore_polygons(types, counts, polygons_aug))
+    return [partial(run, aug_cnt) for aug_cnt in range(1, len(augs) + 1)]
+
+
+def aug_batch(datas: list, backend: str = "IMGAUG") -> list:
+    """
+    对一批图片进行数据增强，每个增强序列对这一批图片只调用一次
+    同一张图片和它所有类型的多边形在同一次调用中增强，所以使用的是同一组随机参数，mask和图片一定对齐
+    :return: 按datas的顺序排列，每张图片依次为各个增强序列的结果，与对每张图片调用aug_data的结果顺序相同
+    """
     global augs
-    segmaps_aug = dict()
+    if backend == "FUSED":
+        return [run() for data in datas for run in plan_aug(data, backend)]
+    flattened = [_flatten_polygons(data) for data in datas]
+    results = [[] for _ in datas]
     aug_cnt = 1
-    for aug in augs:
-        for cur_type in data.mask_polygons.keys():
-            cur_masks = [ia.Polygon(mask) for mask in data.mask_polygons[cur_type]]
-            images_aug, tmp_segmaps_aug = aug(image=data.image, polygons=cur_masks)
-            segmaps_aug[cur_type] = [i.coords for i in tmp_segmaps_aug]  # 把多边形转回坐标
+    for aug, seed in zip(augs, _get_seeds()):
+        aug.seed_(seed)
+        images_aug, polygons_aug = aug(images=[data.image for data in datas],
+                                       polygons=[polygons for _, _, polygons in flattened])
         assert images_aug is not None
-        result.append(DataObj.ImageData(data.name + f"_aug[{aug_cnt}]", images_aug, segmaps_aug))
+        for index, data in enumerate(datas):
+            types, counts, _ = flattened[index]
+            segmaps_aug = _restore_polygons(types, counts, polygons_aug[index])
+            results[index].append(_create_aug_data(data, aug_cnt, images_aug[index], segmaps_aug))
         aug_cnt += 1
-    return result
+    return [aug_data for cur_results in results for aug_data in cur_results]
+
+
+def aug_data(data: DataObj.ImageData, backend: str = "IMGAUG") -> list:
+    return aug_batch([data], backend)
+
+
+def iter_aug_data(data: DataObj.ImageData, backend: str = "IMGAUG", threads: int = 0):
+    """
+    与aug_data相同，但是按顺序逐个返回各个增强序列的结果，用于流式处理
+    :param threads: 同时运行的增强序列数，为0时在当前线程中依次运行；OpenCV的操作不占用GIL，
+        所以后面的序列可以在前一个结果被切割、导出的同时运行，结果与threads无关
+    """
+    runs = plan_aug(data, backend)
+    if threads <= 0:
+        for run in runs:
+            yield run()
+        return
+    pool = _get_pool(threads)
+    pending = [pool.submit(run) for run in runs[:threads]]
+    rest = iter(runs[threads:])
+    try:
+        while pending:
+            future = pending.pop(0)
+            # 取走一个就补充一个，同时在内存中的结果最多为threads + 1个
+            run = next(rest, None)
+            if run is not None:
+                pending.append(pool.submit(run))
+            yield future.result()
+    finally:
+        # 提前停止时等待正在运行的序列，防止同一个增强序列被下一张图片同时使用
+        for future in pending:
+            future.cancel()
+        wait(pending)
@@ -1,37 +1,283 @@
+import json
 import os
 import pickle
+import shutil
+from bisect import bisect_left
 from os import path
 from random import randint
 
 import cv2
 import numpy
 
-from Utils import dump_mask, get_image, read_masks_from_json, write_image, get_mask, counter
+from Metrics import get_metrics
+from Utils import dump_mask, get_image, read_masks_from_json, write_image, get_cropped_mask, counter, \
+    encode_npz, write_file, merge_masks, paste_with_mask, seamless_paste, feather_paste, \
+    multiband_paste, get_bbox, cluster_boxes, pack_polygons, clip_polygon, get_json_name, get_sample_name, \
+    rasterize_polygons, rasterize_label_map, open_image
 
 patch_counter = counter()
 
+OUTPUT_FORMATS = ("MASKS", "LABELMAP", "NPZ")
+PATCH_MODES = ("NORMAL", "SEAMLESS", "FEATHER", "MULTIBAND")
+POLYGON_EPSILON = 1e-3  # 裁剪多边形时与块的右边和下边保持的距离，保证截断后仍在块内
+
+
+class Mask:
+    """
+    稀疏的mask，只保存包围盒以及包围盒内的位图
+    只有在导出等需要完整图片的时候才会通过to_image生成原图大小的mask
+    """
+    __slots__ = ("offset", "bitmap", "shape")
+
+    @classmethod
+    def create_from_polygon(cls, points: list, shape: tuple):
+        """
+        通过多边形的点生成mask
+        :param points:多边形mask的点的信息
+        :param shape:所属图片的(高度, 长度)
+        :rtype: Mask
+        """
+        offset, bitmap = get_cropped_mask(points, shape)
+        return Mask(offset, bitmap, shape)
+
+    @classmethod
+    def create_from_image(cls, image: numpy.ndarray):
+        """
+        通过完整大小的mask图片生成稀疏的mask
+        :rtype: Mask
+        """
+        return Mask((0, 0), image, image.shape[0:2]).tighten()
+
+    @classmethod
+    def create_empty(cls, shape: tuple):
+        """:rtype: Mask"""
+        return Mask((0, 0), numpy.zeros((0, 0), dtype="uint8"), shape)
+
+    def __init__(self, offset: tuple, bitmap: numpy.ndarray, shape: tuple):
+        self.offset = offset  # 包围盒左上角在所属图片中的位置(y, x)
+        self.bitmap = bitmap  # 包围盒内的uint8图片
+        self.shape = tuple(shape[0:2])  # 所属图片的(高度, 长度)
+
+    @property
+    def bbox(self) -> tuple:
+        """返回(y0, x0, y1, x1)，其中y1和x1不包含在内"""
+        return (self.offset[0], self.offset[1],
+                self.offset[0] + self.bitmap.shape[0], self.offset[1] + self.bitmap.shape[1])
+
+    @property
+    def area(self) -> int:
+        return int(numpy.count_nonzero(self.bitmap))
+
+    def is_empty(self) -> bool:
+        return self.bitmap.size == 0 or not self.bitmap.any()
+
+    def tighten(self):
+        """把包围盒缩小到刚好包住所有非零像素
+        :rtype: Mask
+        """
+        if self.is_empty():
+            return Mask.create_empty(self.shape)
+        rows = numpy.flatnonzero(self.bitmap.any(axis=1))
+        cols = numpy.flatnonzero(self.bitmap.any(axis=0))
+        return Mask((self.offset[0] + int(rows[0]), self.offset[1] + int(cols[0])),
+                    self.bitmap[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1],
+                    self.shape)
+
+    def crop(self, pos: tuple, size: tuple, pad: bool = False):
+        """
+        取出图片中某一区域对应的mask，位图使用的是原位图的切片，不会复制
+        :param pos: 区域左上角(y, x)
+        :param size: 区域的(高度, 长度)
+        :param pad: 为False时超出图片的部分会被截掉，为True时新mask的大小一定是size
+        :rtype: Mask
+        """
+        if pad:
+            shape = tuple(size[0:2])
+        else:
+            shape = (min(size[0], self.shape[0] - pos[0]), min(size[1], self.shape[1] - pos[1]))
+        y0, x0, y1, x1 = self.bbox
+        top, left = max(y0, pos[0]), max(x0, pos[1])
+        bottom, right = min(y1, pos[0] + shape[0]), min(x1, pos[1] + shape[1])
+        if bottom <= top or right <= left:
+            return Mask.create_empty(shape)
+        return Mask((top - pos[0], left - pos[1]),
+                    self.bitmap[top - y0:bottom - y0, left - x0:right - x0],
+                    shape)
+
+    def paste(self, pos: tuple, shape: tuple):
+        """
+        把这个mask放到一个更大的图片中的pos位置，超出图片的部分会被截掉
+        :param pos: 本mask所属图片的左上角在新图片中的位置(y, x)
+        :param shape: 新图片的(高度, 长度)
+        :rtype: Mask
+        """
+        moved = Mask((self.offset[0] + pos[0], self.offset[1] + pos[1]), self.bitmap, shape)
+        return moved.crop((0, 0), shape)
+
+    def touches_border(self, value: int = 255) -> bool:
+        """检查所属图片的四条边上是否有这个mask的像素，只需要检查包围盒贴着边的那几条边"""
+        if self.bitmap.size == 0:
+            return False
+        y0, x0, y1, x1 = self.bbox
+        return bool((y0 == 0 and (self.bitmap[0, :] == value).any()) or
+                    (x0 == 0 and (self.bitmap[:, 0] == value).any()) or
+                    (y1 == self.shape[0] and (self.bitmap[-1, :] == value).any()) or
+                    (x1 == self.shape[1] and (self.bitmap[:, -1] == value).any()))
+
+    def to_image(self) -> numpy.ndarray:
+        """生成原图大小的uint8 mask图片"""
+        image = numpy.zeros(self.shape, dtype="uint8")
+        y0, x0, y1, x1 = self.bbox
+        image[y0:y1, x0:x1] = self.bitmap
+        return image
+
+
+class TileGrid:
+    """
+    把图片按照size和stride切成网格
+    通过包围盒直接算出每个mask与哪几块相交，切割时每一块只需要处理与它相交的mask
+    """
+
+    def __init__(self, shape: tuple, size: tuple, stride: tuple = None, pad: bool = False):
+        """
+        :param shape: 图片的(高度, 长度)
+        :param size: 每一块的(高度, 长度)
+        :param stride: 相邻两块之间的距离(高度, 长度)，小于size时相邻的块会重叠，默认等于size
+        :param pad: 为False时最后一行和最后一列可能比size小，为True时会用0补齐到size
+        """
+        self.shape = tuple(shape[0:2])
+        self.size = tuple(size[0:2])
+        self.stride = self.size if not stride else tuple(stride[0:2])
+        self.pad = pad
+        self.rows = self._get_starts(self.shape[0], self.size[0], self.stride[0])
+        self.cols = self._get_starts(self.shape[1], self.size[1], self.stride[1])
+
+    @staticmethod
+    def _get_starts(length: int, size: int, stride: int) -> list:
+        """每一块的起点，如果上一块已经到达了图片的末尾，就不再需要新的一块"""
+        starts = []
+        for start in range(0, length, stride):
+            if starts and starts[-1] + size >= length:
+                break
+            starts.append(start)
+        return starts
+
+    def __len__(self) -> int:
+        return len(self.rows) * len(self.cols)
+
+    @property
+    def windows(self) -> list:
+        """每一块左上角的坐标(y, x)，按行排列"""
+        return [(row, col) for row in self.rows for col in self.cols]
+
+    def get_tile(self, image: numpy.ndarray, window: tuple) -> numpy.ndarray:
+        """取出一块图片，不需要补齐时返回的是原图的切片"""
+        tile = image[window[0]:window[0] + self.size[0], window[1]:window[1] + self.size[1]]
+        if self.pad and tile.shape[0:2] != self.size:
+            padding = [(0, self.size[0] - tile.shape[0]), (0, self.size[1] - tile.shape[1])]
+            tile = numpy.pad(tile, padding + [(0, 0)] * (tile.ndim - 2))
+        return tile
+
+    def get_overlapping(self, bbox: tuple) -> list:
+        """返回与包围盒(y0, x0, y1, x1)相交的所有块的编号"""
+        y0, x0, y1, x1 = bbox
+        if y1 <= y0 or x1 <= x0:
+            return []
+        # 与[y0, y1)相交的块满足 start < y1 且 start + size > y0
+        row_range = range(bisect_left(self.rows, y0 - self.size[0] + 1), bisect_left(self.rows, y1))
+        col_range = range(bisect_left(self.cols, x0 - self.size[1] + 1), bisect_left(self.cols, x1))
+        return [row * len(self.cols) + col for row in row_range for col in col_range]
+
+    def assign(self, masks: list, bboxes: list = None) -> list:
+        """
+        把mask分配到与它相交的块中，每一块中的mask保持原来的顺序
+        :param bboxes: 每个mask的包围盒，默认使用mask.bbox，用于分配多边形等其它对象
+        :return: 与windows顺序相同的列表，每一项为与该块相交的mask列表
+        """
+        result = [[] for _ in range(len(self))]
+        if bboxes is None:
+            bboxes = [mask.bbox for mask in masks]
+        for mask, bbox in zip(masks, bboxes):
+            for index in self.get_overlapping(bbox):
+                result[index].append(mask)
+        return result
+
+    def iter_tiles(self, image: numpy.ndarray, mask_images: dict):
+        """
+        依次生成每一块的(左上角坐标, 图片, mask字典)
+        mask只裁出与该块相交的包围盒部分，不会生成空的mask
+        """
+        assigned = {mask_type: self.assign(masks) for mask_type, masks in mask_images.items()}
+        for index, window in enumerate(self.windows):
+            cur_masks = dict()
+            for mask_type in mask_images.keys():
+                cur_masks[mask_type] = [mask for mask in
+                                        (i.crop(window, self.size, self.pad) for i in assigned[mask_type][index])
+                                        if not mask.is_empty()]
+                # 包围盒相交但实际没有重叠像素的mask
+                get_metrics().count("masks_dropped", len(assigned[mask_type][index]) - len(cur_masks[mask_type]))
+            yield window, self.get_tile(image, window), cur_masks
+
 
 class ImageData:
     @classmethod
-    def create_from_file(cls, file_name: str, source_path: str):
+    def create_from_file(cls, file_name: str, source_path: str, cache=None):
         """通过文件名和路径来获取数据，需要图片和同名json
+        :param cache: Cache.DecodeCache，使用时会跳过已经缓存过的解码和栅格化
         :rtype: ImageData
         """
+        if cache is not None:
+            return cache.create_image_data(file_name, source_path)
         file_path = path.join(source_path, file_name)  # 该文件的完整路径
-        json_file = path.join(source_path, file_name[:-4] + ".json")
+        json_file = path.join(source_path, get_json_name(file_name))
         image = get_image(file_path)
         masks = read_masks_from_json(json_file)
-        return ImageData(file_name[:-4], image, masks)
+        return ImageData(get_sample_name(file_name), image, masks)
+
+    @classmethod
+    def open_from_file(cls, file_name: str, source_path: str, cache=None):
+        """
+        与create_from_file相同，但是图片以只读的内存映射打开，mask保持多边形形式，用于非常大的图片
+        配合iter_split(clip_polygons=True)使用时，每一块只读取自己的区域、只栅格化与自己相交的多边形
+        :param cache: Cache.DecodeCache，没有时图片只能完整解码到内存中
+        :rtype: ImageData
+        """
+        file_path = path.join(source_path, file_name)
+        image = cache.open_image(file_name, source_path) if cache is not None else open_image(file_path)
+        masks = read_masks_from_json(path.join(source_path, get_json_name(file_name)))
+        return ImageData(get_sample_name(file_name), image, masks)
 
     def __init__(self, file_name: str, image: numpy.ndarray, mask_polygons: dict | None):
-        # noinspection PyTypeChecker
-        self.mask_images: dict = None
+        """
+        :param mask_polygons: 每个类型的多边形列表，有多边形时mask在第一次使用时才生成，见mask_images
+        """
+        self._mask_images: dict | None = None
         self.name = file_name  # 这个是用于保存的ID
         self.image = image
         self.mask_polygons = mask_polygons
         self.shape: tuple = self.image.shape
-        if mask_polygons is not None:
+        # 从源图片得到这一块所经过的处理，每一步为{"stage": 阶段, "index": 编号, ...}，会写入Index
+        self.lineage: list = []
+
+    @property
+    def mask_images(self) -> dict | None:
+        """
+        每个类型的Mask列表
+        有多边形时第一次访问才会栅格化，所以只经过AUG和多边形SPLIT的数据不需要生成任何位图
+        有多边形时mask一定是由多边形生成的，修改mask的操作(例如贴图)都会生成没有多边形的新ImageData
+        """
+        if self._mask_images is None and self.mask_polygons is not None:
             self.convert_polygons_to_images()
+        return self._mask_images
+
+    @mask_images.setter
+    def mask_images(self, mask_images: dict | None):
+        self._mask_images = mask_images
+
+    @property
+    def rasterized(self) -> bool:
+        """mask是否已经生成"""
+        return self._mask_images is not None
 
     @property
     def types(self) -> set:
@@ -45,78 +291,285 @@ class ImageData:
         return types
 
     def convert_polygons_to_images(self):
-        self.mask_images = dict()
-        for mask_type in self.types:
-            cur_masks = []
-            for mask_polygon in self.mask_polygons[mask_type]:
-                cur_masks.append(get_mask(mask_polygon, self.shape))
-            self.mask_images[mask_type] = cur_masks
+        """一次栅格化每个类型的所有多边形，见Utils.rasterize_polygons"""
+        mask_images = dict()
+        for mask_type in self.mask_polygons.keys():
+            mask_images[mask_type] = [Mask(offset, bitmap, self.shape) for offset, bitmap in
+                                      rasterize_polygons(self.mask_polygons[mask_type], self.shape)]
+        self.mask_images = mask_images
 
-    def dump_masks_and_image(self, target_path: str):
-        """把图片和mask按照格式导出到target_path"""
-        assert self.mask_images is not None
+    def dump_masks_and_image(self, target_path: str, writer=None) -> list:
+        """
+        把图片和mask按照格式导出到target_path
+        :param writer: Writer.AsyncWriter，为None时直接在当前线程中写入
+        :return: 导出的文件(相对于target_path)，导出失败时为空列表
+        """
+        # 还没有栅格化时，在写入线程中才把每个多边形栅格化
+        lazy = writer is not None and not self.rasterized and self.mask_polygons is not None
+        masks = self.mask_polygons if lazy else self.mask_images
+        assert masks is not None
         testarr = []
         for mask_type in self.types:
-            testarr += self.mask_images[mask_type]
+            testarr += list(masks[mask_type])
         if len(testarr) == 0:
             print(f"文件 {self.name} 导出失败，原因是没有mask")
-            return
+            return []
 
-        # 创建Mask和Image的文件夹
+        # 创建Mask和Image的文件夹，上次中断时留下的同名文件夹需要先删除
         folder_name = self.name
+        shutil.rmtree(path.join(target_path, folder_name), ignore_errors=True)
         mask_folder_path = path.join(target_path, folder_name, "masks")
         os.makedirs(mask_folder_path)
         image_path = path.join(target_path, folder_name, "images")
         os.makedirs(image_path)
+        files = []
 
         # 按照Mask类型顺序导出
-        for mask_type in self.types:
-            if not self.mask_images[mask_type]:
+        for mask_type in sorted(self.types):
+            if len(masks[mask_type]) == 0:
                 print(f"文件 [{mask_type}]{self.name} 导出失败，原因是没有mask")
                 # 如果无mask，则不导出
                 continue
             # 把mask中的各个类别分别输出
-            for index in range(len(self.mask_images[mask_type])):
+            for index in range(len(masks[mask_type])):
                 # 导出mask文件
-                cur_mask = self.mask_images[mask_type][index]
+                cur_mask = masks[mask_type][index]
                 cur_mask_name = f"[{mask_type}]" + str(index)
-                dump_mask(mask_folder_path, cur_mask_name, cur_mask)
-            # 导出对应图片
+                files.append(path.join(folder_name, "masks", cur_mask_name + ".png"))
+                if writer is None:
+                    dump_mask(mask_folder_path, cur_mask_name, cur_mask.to_image())
+                elif lazy:
+                    writer.write_png(path.join(mask_folder_path, cur_mask_name + ".png"),
+                                     lambda points=cur_mask: Mask.create_from_polygon(points, self.shape).to_image())
+                else:
+                    # 完整大小的mask在写入线程中才生成
+                    writer.write_png(path.join(mask_folder_path, cur_mask_name + ".png"), cur_mask.to_image)
+        # 导出对应图片，只需要导出一次
+        if writer is None:
             write_image(image_path, self.name, self.image)
+        else:
+            writer.write_png(path.join(image_path, self.name + ".png"), self.image)
+        files.append(path.join(folder_name, "images", self.name + ".png"))
+        return files
+
+    def dump(self, target_path: str, output_format: str = "MASKS", class_ids: dict = None, writer=None) -> list:
+        """
+        按照output_format导出到target_path
+        MASKS: 每个物体一个mask图片，见dump_masks_and_image
+        LABELMAP: 每张图片一个实例图和一个类别图，见dump_label_map
+        NPZ: 每张图片一个压缩文件，见dump_npz
+        :return: 导出的文件(相对于target_path)，导出失败时为空列表
+        """
+        if output_format == "MASKS":
+            return self.dump_masks_and_image(target_path, writer)
+        elif output_format == "LABELMAP":
+            return self.dump_label_map(target_path, class_ids, writer)
+        elif output_format == "NPZ":
+            return self.dump_npz(target_path, writer)
+        else:
+            raise ValueError(f"无效的导出格式: {output_format}")
+
+    @property
+    def mask_count(self) -> int:
+        if not self.rasterized and self.mask_polygons is not None:
+            # 每个多边形对应一个mask，不需要为了计数而栅格化
+            return sum(len(self.mask_polygons[mask_type]) for mask_type in self.types)
+        return sum(len(self.mask_images[mask_type]) for mask_type in self.types)
+
+    def get_label_maps(self, class_ids: dict) -> tuple:
+        """
+        把所有mask合并为一张实例图和一张类别图
+        实例编号按类型名的顺序从1开始，0为背景；物体重叠时后面的会覆盖前面的
+        :param class_ids: 类型 -> 类别编号(1-255)
+        :return: (uint16的实例图, uint8的类别图)
+        """
+        if self.mask_count > numpy.iinfo("uint16").max:
+            raise ValueError(f"{self.name} 中的物体太多，无法保存为uint16的实例图")
+        for mask_type in self.types:
+            if mask_type not in class_ids:
+                raise ValueError(f"类型 {mask_type} 没有在CLASS_IDS中设置类别编号")
+        if not self.rasterized and self.mask_polygons is not None:
+            # 还没有栅格化时直接把多边形画到实例图上，不需要生成每个mask
+            polygons, classes = [], []
+            for mask_type in sorted(self.types):
+                polygons += self.mask_polygons[mask_type]
+                classes += [class_ids[mask_type]] * len(self.mask_polygons[mask_type])
+            return rasterize_label_map(polygons, self.shape, classes)
+        instances = numpy.zeros(self.shape[0:2], dtype="uint16")
+        classes = numpy.zeros(self.shape[0:2], dtype="uint8")
+        instance_id = 0
+        for mask_type in sorted(self.types):
+            for mask in self.mask_images[mask_type]:
+                instance_id += 1
+                y0, x0, y1, x1 = mask.bbox
+                region = mask.bitmap > 0
+                instances[y0:y1, x0:x1][region] = instance_id
+                classes[y0:y1, x0:x1][region] = class_ids[mask_type]
+        return instances, classes
+
+    def dump_label_map(self, target_path: str, class_ids: dict, writer=None) -> list:
+        """
+        导出为：
+        target_path/images/名称.png     图片
+        target_path/instances/名称.png  uint16的实例图
+        target_path/classes/名称.png    uint8的类别图
+        """
+        if self.mask_count == 0:
+            print(f"文件 {self.name} 导出失败，原因是没有mask")
+            return []
+        for folder in ("images", "instances", "classes"):
+            os.makedirs(path.join(target_path, folder), exist_ok=True)
+        instances, classes = self.get_label_maps(class_ids)
+        if writer is None:
+            write_image(path.join(target_path, "images"), self.name, self.image)
+            write_image(path.join(target_path, "instances"), self.name, instances)
+            write_image(path.join(target_path, "classes"), self.name, classes)
+        else:
+            file_name = self.name + ".png"
+            writer.write_png(path.join(target_path, "images", file_name), self.image)
+            writer.write_png(path.join(target_path, "instances", file_name), instances)
+            writer.write_png(path.join(target_path, "classes", file_name), classes)
+        return [path.join(folder, self.name + ".png") for folder in ("images", "instances", "classes")]
+
+    def get_npz_arrays(self) -> dict:
+        """
+        生成dump_npz所需的数组，所有mask都按包围盒保存，不会丢失重叠的部分
+        image: 图片
+        mask_types: 每个mask的类型
+        mask_boxes: 每个mask的包围盒(y0, x0, y1, x1)
+        mask_bits: 所有mask包围盒内的位图按顺序拼接后用packbits压缩
+        """
+        types, boxes, bits = [], [], []
+        for mask_type in sorted(self.types):
+            for mask in self.mask_images[mask_type]:
+                types.append(mask_type)
+                boxes.append(mask.bbox)
+                bits.append((mask.bitmap > 0).ravel())
+        return {
+            "image": self.image,
+            "mask_types": numpy.array(types, dtype="U"),
+            "mask_boxes": numpy.array(boxes, dtype="int32").reshape(-1, 4),
+            "mask_bits": numpy.packbits(numpy.concatenate(bits) if bits else numpy.zeros(0, dtype=bool)),
+        }
+
+    def dump_npz(self, target_path: str, writer=None) -> list:
+        """导出为target_path/名称.npz，可以用create_from_npz读取"""
+        if self.mask_count == 0:
+            print(f"文件 {self.name} 导出失败，原因是没有mask")
+            return []
+        os.makedirs(target_path, exist_ok=True)
+        file_path = path.join(target_path, self.name + ".npz")
+        if writer is None:
+            write_file(file_path, encode_npz(self.get_npz_arrays()))
+        else:
+            writer.write(file_path, lambda: encode_npz(self.get_npz_arrays()))
+        return [self.name + ".npz"]
+
+    @classmethod
+    def create_from_npz(cls, file_path: str):
+        """
+        读取dump_npz导出的文件
+        :rtype: ImageData
+        """
+        with numpy.load(file_path) as npz:
+            image = npz["image"]
+            bits = numpy.unpackbits(npz["mask_bits"]).astype("uint8") * 255
+            mask_images = dict()
+            start = 0
+            for mask_type, (y0, x0, y1, x1) in zip(npz["mask_types"], npz["mask_boxes"]):
+                size = (y1 - y0) * (x1 - x0)
+                bitmap = bits[start:start + size].reshape(y1 - y0, x1 - x0)
+                mask_images.setdefault(str(mask_type), []).append(Mask((int(y0), int(x0)), bitmap, image.shape))
+                start += size
+            # 缓存的文件中还会保存多边形
+            mask_polygons = json.loads(str(npz["polygons"])) if "polygons" in npz else None
+        # noinspection PyTypeChecker
+        result = ImageData(path.basename(file_path)[:-4], image, None)
+        if mask_polygons is not None:
+            for mask_type in mask_polygons.keys():
+                mask_images.setdefault(mask_type, [])
+            result.mask_polygons = mask_polygons
+        result.mask_images = mask_images
+        return result
 
     def drop_empty_masks(self):
         """去掉空的mask"""
         for mask_type in self.types:
-            self.mask_images[mask_type] = [mask for mask in self.mask_images[mask_type] if not (mask == 0).all()]
+            self.mask_images[mask_type] = [mask for mask in self.mask_images[mask_type] if not mask.is_empty()]
 
-    def split(self, size: tuple):
+    def split(self, size: tuple, stride: tuple = None, pad: bool = False, clip_polygons: bool = False):
+        return list(self.iter_split(size, stride, pad, clip_polygons))
+
+    def iter_split(self, size: tuple, stride: tuple = None, pad: bool = False, clip_polygons: bool = False):
+        """
+        与split相同，但是每次只生成一块，用于流式处理
+        :param stride: 相邻两块之间的距离，小于size时会重叠，默认等于size
+        :param pad: 是否用0把边缘的块补齐到size
+        :param clip_polygons: 有多边形时直接裁剪多边形，生成的每一块也只有多边形，不需要栅格化
+        """
+        if clip_polygons and self.mask_polygons is not None:
+            yield from self._iter_split_polygons(size, stride, pad)
+            return
         # 因为生成patch时需要mask，所以不能为空
         assert self.mask_images is not None
-        results = []
-        # 切开原始图像
-        patch_images = split_img(self.image, size)
-        # 把原始mask图片也切开
-        patch_masks = dict()
-        for mask_type in self.types:
-            patch_masks[mask_type] = list()
-            for origin_mask_image in self.mask_images[mask_type]:
-                patch_masks[mask_type].append(split_mask(origin_mask_image, size))
-        # 按顺序进行组合，放入Patch对象
+        # 按顺序切开原始图像，每一块只裁剪与它相交的mask
         cnt = 1
-        for i in range(len(patch_images)):
-            cur_patch_image = patch_images[i]
-            cur_patch_masks = dict()
-            for mask_type in self.types:
-                cur_patch_masks[mask_type] = list()
-                for mask in patch_masks[mask_type]:
-                    cur_patch_masks[mask_type].append(mask[i])
+        grid = TileGrid(self.shape, size, stride, pad)
+        for window, cur_patch_image, cur_patch_masks in grid.iter_tiles(self.image, self.mask_images):
             # noinspection PyTypeChecker
             new_image_data = ImageData(self.name + f"_split[{cnt}]", cur_patch_image, None)
             new_image_data.mask_images = cur_patch_masks
-            new_image_data.drop_empty_masks()
-            results.append(new_image_data)
+            new_image_data.lineage = self._split_lineage(cnt, window, cur_patch_image.shape)
+            yield new_image_data
             cnt += 1
-        return results
+
+    def _iter_split_polygons(self, size: tuple, stride: tuple = None, pad: bool = False):
+        """iter_split的多边形版本，完全在块内的多边形只需要平移，只有跨过块边缘的多边形才需要裁剪"""
+        grid = TileGrid(self.shape, size, stride, pad)
+        packed = dict()
+        assigned = dict()
+        for mask_type, polygons in self.mask_polygons.items():
+            points, starts, bounds = pack_polygons(polygons)
+            packed[mask_type] = (points, starts, bounds)
+            # 栅格化时坐标会被截断为整数，多边形可能覆盖的像素为[floor(最小值), floor(最大值)]
+            with numpy.errstate(invalid="ignore"):
+                pixel_bounds = numpy.nan_to_num(numpy.floor(bounds), posinf=0, neginf=-1).astype(int)
+            bboxes = [(y0, x0, y1 + 1, x1 + 1) for x0, y0, x1, y1 in pixel_bounds.tolist()]
+            assigned[mask_type] = grid.assign(list(range(len(polygons))), bboxes)
+        metrics = get_metrics()
+        cnt = 1
+        for index, window in enumerate(grid.windows):
+            # 保留[0, 长度)范围内的部分，截断后仍在块内
+            height = min(grid.size[0], self.shape[0] - window[0])
+            width = min(grid.size[1], self.shape[1] - window[1])
+            limits = (window[1], window[0], window[1] + width - POLYGON_EPSILON, window[0] + height - POLYGON_EPSILON)
+            offset = numpy.array([window[1], window[0]], dtype="float64")
+            cur_polygons = dict()
+            for mask_type in self.mask_polygons.keys():
+                points, starts, bounds = packed[mask_type]
+                indexes = assigned[mask_type][index]
+                cur_bounds = bounds[indexes].reshape(-1, 4)
+                inside = ((cur_bounds[:, 0:2] >= limits[0:2]) & (cur_bounds[:, 2:4] <= limits[2:4])).all(axis=1)
+                cur_polygons[mask_type] = []
+                for i, is_inside in zip(indexes, inside.tolist()):
+                    polygon = points[starts[i]:starts[i + 1]] - offset
+                    if not is_inside:
+                        polygon = clip_polygon(polygon, (0, 0, limits[2] - limits[0], limits[3] - limits[1]))
+                    if len(polygon) >= 3:
+                        cur_polygons[mask_type].append(polygon)
+                metrics.count("masks_dropped", len(indexes) - len(cur_polygons[mask_type]))
+            tile = grid.get_tile(self.image, window)
+            if isinstance(tile, numpy.memmap):
+                # 只从映射的文件中读取这一块，之后的处理不再依赖该文件
+                tile = numpy.array(tile)
+            new_image_data = ImageData(self.name + f"_split[{cnt}]", tile, cur_polygons)
+            new_image_data.lineage = self._split_lineage(cnt, window, new_image_data.shape)
+            yield new_image_data
+            cnt += 1
+
+    def _split_lineage(self, index: int, window: tuple, shape: tuple) -> list:
+        """切割出的块的lineage，记录该块在上一步图片中的位置(y, x, 高度, 长度)"""
+        return self.lineage + [{"stage": "split", "index": index, "window": [window[0], window[1], shape[0], shape[1]]}]
 
     def __str__(self) -> str:
         describe = f"Name:{self.name} Shape:{self.shape} Types:{self.types}"
@@ -130,23 +583,9 @@ class Patch:
         # 因为生成patch时需要mask，所以不能为空
         assert data.mask_images is not None
         results = []
-        # 切开原始图像
-        patch_images = split_img(data.image, patch_size)
-        # 把原始mask图片也切开
-        patch_masks = dict()
-        for mask_type in data.types:
-            patch_masks[mask_type] = list()
-            for origin_mask_image in data.mask_images[mask_type]:
-                new_masks = split_mask(origin_mask_image, patch_size)
-                patch_masks[mask_type].append(new_masks)
-        # 按顺序进行组合，放入Patch对象
-        for i in range(len(patch_images)):
-            cur_patch_image = patch_images[i]
-            cur_patch_masks = dict()
-            for mask_type in data.types:
-                cur_patch_masks[mask_type] = list()
-                for mask in patch_masks[mask_type]:
-                    cur_patch_masks[mask_type].append(mask[i])
+        # 按顺序切开原始图像，每一块只裁剪与它相交的mask，放入Patch对象
+        grid = TileGrid(data.shape, patch_size)
+        for _, cur_patch_image, cur_patch_masks in grid.iter_tiles(data.image, data.mask_images):
             # TODO：删除非H的
             cur_patch = Patch(cur_patch_image, cur_patch_masks)
             if cur_patch.flag:
@@ -154,13 +593,56 @@ class Patch:
         if len(results) < 1: print(data.name, "没有h标签，没有生成任何Patch")
         return results
 
+    @classmethod
+    def create_from_objects(cls, data: ImageData, max_size: tuple = (128, 128), margin: int = 4) -> list:
+        """
+        以h物体为中心裁剪出大小不固定的Patch，每个Patch包含完整的物体
+        相距小于margin的物体会放在同一个Patch中，Patch的范围是这些物体的包围盒向外扩展margin，
+        所以Patch中不会有被截断的物体
+        被图片边缘截断的物体和超过max_size的物体组会被跳过，只需要比较包围盒
+        :param max_size: Patch的最大(高度, 长度)
+        :param margin: 物体周围保留的背景宽度
+        """
+        assert data.mask_images is not None
+        masks = [mask for mask in data.mask_images.get("h", []) if not mask.is_empty()]
+        results = []
+        skipped = 0
+        for (y0, x0, y1, x1), indexes in cluster_boxes([mask.bbox for mask in masks], margin):
+            if y0 == 0 or x0 == 0 or y1 == data.shape[0] or x1 == data.shape[1]:
+                # 包围盒贴着图片边缘，说明物体可能被截断了
+                skipped += len(indexes)
+                continue
+            pos = (max(y0 - margin, 0), max(x0 - margin, 0))
+            size = (min(y1 + margin, data.shape[0]) - pos[0], min(x1 + margin, data.shape[1]) - pos[1])
+            if size[0] > max_size[0] or size[1] > max_size[1]:
+                skipped += len(indexes)
+                continue
+            image = data.image[pos[0]:pos[0] + size[0], pos[1]:pos[1] + size[1]].copy()
+            results.append(Patch(image, {"h": [masks[i].crop(pos, size) for i in indexes]}))
+        get_metrics().count("objects_skipped", skipped)
+        if len(results) < 1:
+            print(data.name, "没有完整的h物体，没有生成任何Patch")
+        elif skipped:
+            print(f"{data.name} 中有 {skipped} 个h物体被图片边缘截断或者所在的组超过了最大大小，已跳过")
+        return results
+
     @classmethod
     def load_from_folder(cls, source_path: str):
+        """读取文件夹中所有旧的pickle格式Patch(.patch)，新的打包格式请使用PatchArchive.load_patches"""
+        file_names = sorted(os.listdir(source_path))  # 保证顺序固定，随机选择才可复现
+        return cls.load_from_files([path.join(source_path, name) for name in file_names if name.endswith(".patch")])
+
+    @classmethod
+    def load_from_files(cls, file_paths: list):
         result: list[cls] = []
-        file_names = os.listdir(source_path)
-        for name in file_names:
-            with open(path.join(source_path, name), mode="rb") as file:
-                result.append(pickle.load(file))
+        for file_path in file_paths:
+            with open(file_path, mode="rb") as file:
+                patch = pickle.load(file)
+            # 旧版本的Patch中mask是完整大小的图片，需要转换为稀疏的mask
+            for mask_type in patch.mask_images.keys():
+                patch.mask_images[mask_type] = [mask if isinstance(mask, Mask) else Mask.create_from_image(mask)
+                                                for mask in patch.mask_images[mask_type]]
+            result.append(patch)
         return result
 
     def __init__(self, image: numpy.ndarray, mask_images: dict):
@@ -201,131 +683,178 @@ class Patch:
         True表示正常，False表示有物体被分割
         """
         for mask_type in self.mask_images.keys():
-            for mask_image in self.mask_images[mask_type]:
-                x, y = mask_image.shape
-                white = 255
-                for cur_x in range(x):
-                    if (mask_image[cur_x, y - 1] == white or  # Shape中的x和y是从1开始的，所以需要-1
-                            mask_image[cur_x, 0] == white):
-                        return False
-                for cur_y in range(y):
-                    if (mask_image[x - 1, cur_y] == white or
-                            mask_image[0, cur_y] == white):
-                        return False
+            for mask in self.mask_images[mask_type]:
+                if mask.touches_border():
+                    return False
         return True
 
+    def get_union_mask(self, mask_type: str = "h") -> numpy.ndarray:
+        """返回与patch大小相同的bool图，表示该类型所有mask的并集"""
+        return merge_masks([(mask.offset, mask.bitmap) for mask in self.mask_images.get(mask_type, [])], self.shape)
+
+    def get_blend_mask(self, radius: int) -> numpy.ndarray:
+        """返回h的并集向外扩展radius像素后的bool图，作为融合贴图时贴上的区域"""
+        mask = self.get_union_mask("h")
+        if radius > 0:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+            mask = cv2.dilate(mask.astype("uint8"), kernel).astype(bool)
+        return mask
+
+    def get_footprint(self, mode: str = "NORMAL", delete_bg: bool = False, blend_radius: int = 4) -> numpy.ndarray:
+        """
+        返回与patch大小相同的bool图，表示贴图时原图中可能被改变的像素
+        SEAMLESS会改变融合区域的整个包围盒，MULTIBAND的低频部分会扩散到整个patch
+        """
+        if mode == "NORMAL" and delete_bg:
+            return self.get_union_mask("h")
+        if mode == "FEATHER":
+            return self.get_blend_mask(blend_radius)
+        footprint = numpy.zeros(self.shape, dtype=bool)
+        if mode == "SEAMLESS":
+            bbox = get_bbox(self.get_blend_mask(blend_radius))
+            if bbox is not None:
+                footprint[bbox[0]:bbox[2], bbox[1]:bbox[3]] = True
+        else:
+            footprint[...] = True
+        return footprint
+
     def apply_to_image_data(self, data: ImageData, pos: tuple = None, delete_bg: bool = False,
-                            mode="NORMAL") -> ImageData:
+                            mode="NORMAL", blend_radius: int = 4) -> ImageData:
+        """
+        把patch贴到data上，返回新的ImageData，data本身不会被修改
+        :param mode: 贴图方式，见PATCH_MODES
+        :param blend_radius: 融合贴图时h区域向外扩展的像素数，FEATHER模式下也是羽化的宽度
+        """
         # 因为需要把新的mask覆盖到旧的上面，所以旧的必须存在
         assert data.mask_images is not None
         if mode == "NORMAL":
             return self.apply_to_image_data_normal(data, pos, delete_bg)
+        elif mode in PATCH_MODES:
+            assert delete_bg == False, "在融合模式下，不能去除背景"
+            return self.apply_to_image_data_blend(data, pos, mode, blend_radius)
+        else:
+            raise ValueError(f"无效的贴图方式: {mode}")
+
+    @classmethod
+    def apply_patches_to_image_data(cls, data: ImageData, patches: list, delete_bg: bool = False,
+                                    mode: str = "NORMAL", blend_radius: int = 4, max_tries: int = 50,
+                                    allow_overlap: bool = False) -> ImageData:
+        """
+        把多个patch一次贴到data上，返回新的ImageData，data本身不会被修改，图片只复制一次
+        用一张占用图记录已有的物体和已经贴上的patch，每个patch最多随机尝试max_tries个位置，
+        选择不会覆盖到已占用像素的位置，找不到时跳过该patch
+        :param patches: 依次贴上的Patch列表
+        :param allow_overlap: 为True时不检查重叠，直接使用第一个随机位置
+        """
+        assert data.mask_images is not None
+        if mode not in PATCH_MODES:
+            raise ValueError(f"无效的贴图方式: {mode}")
+        assert mode == "NORMAL" or delete_bg == False, "在融合模式下，不能去除背景"
+        new_data = ImageData(data.name, data.image.copy(), None)
+        new_data.mask_images = {mask_type: list(masks) for mask_type, masks in data.mask_images.items()}
+        new_data.lineage = list(data.lineage)
+        occupied = None
+        if not allow_overlap:
+            occupied = merge_masks([(mask.offset, mask.bitmap) for mask_type in data.types
+                                    for mask in data.mask_images[mask_type]], data.shape)
+        metrics = get_metrics()
+        for patch in patches:
+            footprint = None if occupied is None else patch.get_footprint(mode, delete_bg, blend_radius)
+            pos = patch._find_position(data.shape, occupied, footprint, max_tries)
+            if pos is None:
+                metrics.count("patches_skipped")
+                continue
+            if occupied is not None:
+                occupied[pos[0]:pos[0] + patch.shape[0], pos[1]:pos[1] + patch.shape[1]] |= footprint
+            index = next(patch_counter)
+            new_data.name += f"_patch[{index}]"
+            new_data.lineage.append({"stage": "patch", "index": index, "pos": list(pos)})
+            patch._paste_masks(new_data, pos)
+            patch._paste_image(new_data.image, pos, mode, delete_bg, blend_radius)
+            metrics.count("patches_applied")
+        return new_data
+
+    def _random_position(self, shape: tuple) -> tuple:
+        """随机取点，取的点要保证能放下一个patch"""
+        return randint(0, shape[0] - self.shape[0]), randint(0, shape[1] - self.shape[1])
+
+    def _find_position(self, shape: tuple, occupied: numpy.ndarray | None, footprint: numpy.ndarray | None,
+                       max_tries: int):
+        """随机寻找footprint不会覆盖到occupied的位置，occupied为None时直接返回随机位置，找不到时返回None"""
+        if occupied is None:
+            return self._random_position(shape)
+        bbox = get_bbox(footprint)
+        if bbox is None:
+            return self._random_position(shape)
+        y0, x0, y1, x1 = bbox
+        cur_footprint = footprint[y0:y1, x0:x1]
+        for _ in range(max_tries):
+            pos = self._random_position(shape)
+            region = occupied[pos[0] + y0:pos[0] + y1, pos[1] + x0:pos[1] + x1]
+            if not (region & cur_footprint).any():
+                return pos
+        return None
+
+    def _paste_masks(self, data: ImageData, pos: tuple):
+        """把mask从小的变换到大坐标系中，再加到data上，直接修改data"""
+        for mask_type in self.mask_images.keys():
+            new_masks = [mask.paste(pos, data.shape) for mask in self.mask_images[mask_type]]
+            data.mask_images.setdefault(mask_type, []).extend(new_masks)
+
+    def _paste_image(self, image: numpy.ndarray, pos: tuple, mode: str = "NORMAL", delete_bg: bool = False,
+                     blend_radius: int = 4):
+        """按照mode把patch的图片贴到image的pos位置上，直接修改image"""
+        if mode == "NORMAL":
+            if not delete_bg:
+                # 把patch的图片覆盖到原图指定位置上
+                image[pos[0]:pos[0] + self.shape[0], pos[1]:pos[1] + self.shape[1], :] = self.image
+            else:
+                # 只贴上h的部分
+                paste_with_mask(image, self.image, self.get_union_mask("h"), pos)
         elif mode == "SEAMLESS":
-            assert delete_bg == False, "在无缝模式下，不能去除背景"
-            return self.apply_to_image_data_seamless(data, pos, delete_bg)
+            seamless_paste(image, self.image, self.get_blend_mask(blend_radius), pos)
+        elif mode == "FEATHER":
+            feather_paste(image, self.image, self.get_blend_mask(blend_radius), pos, blend_radius)
+        elif mode == "MULTIBAND":
+            multiband_paste(image, self.image, self.get_blend_mask(blend_radius), pos)
         else:
-            raise "无效的贴图方式"
+            raise ValueError(f"无效的贴图方式: {mode}")
 
-    def apply_to_image_data_seamless(self, data: ImageData, pos: tuple = None, delete_bg: bool = False) -> ImageData:
-        # TODO:完成这种贴图方式
+    def _create_patched_data(self, data: ImageData, pos: tuple = None) -> tuple:
+        """
+        复制data并把patch的mask贴到pos位置上，图片由调用者负责贴上
+        :return: (新的ImageData, 实际的pos)
+        """
         # 需要使用copy来解决引用问题
-        new_data = ImageData(data.name + f"_patch[{next(patch_counter)}]", data.image.copy(), None)
-        new_data.mask_images = data.mask_images.copy()
+        index = next(patch_counter)
+        new_data = ImageData(data.name + f"_patch[{index}]", data.image.copy(), None)
+        new_data.mask_images = {mask_type: list(masks) for mask_type, masks in data.mask_images.items()}
         if pos is None:
-            # 如果没指定位置，则随机取点，取的点要保证能放下一个patch
-            pos = (randint(0, new_data.shape[0] - self.shape[0]),
-                   randint(0, new_data.shape[1] - self.shape[1]))
-        # 把patch的图片覆盖到原图指定位置上
-        patch_mask = numpy.ones_like(self.image) * 255
-        new_data.image = cv2.seamlessClone(
-            self.image,
-            new_data.image,
-            patch_mask,
-            (pos[1] + self.shape[1] // 2, pos[0] + self.shape[0] // 2),
-            cv2.MIXED_CLONE
-        )
-        # new_data.image[pos[0]:pos[0] + self.shape[0], pos[1]:pos[1] + self.shape[1], :] = self.image
-        # 把mask从小的变换到大坐标系中
-        new_mask_images = dict()
-        empty_mask = numpy.zeros((data.image.shape[0], data.image.shape[1]), dtype="uint8")
-        for mask_type in self.mask_images.keys():
-            new_mask_images[mask_type] = []
-            for mask_index in range(len(self.mask_images[mask_type])):
-                cur_big_mask = empty_mask.copy()
-                # cur_big_mask[pos[0]:pos[0] + self.shape[0], pos[1]:pos[1] + self.shape[1]] = \
-                #    self.mask_images[mask_type][mask_index]
-                new_mask_images[mask_type].append(cur_big_mask)
-        # 把mask也贴到原图上
-        for mask_type in new_mask_images.keys():
-            if mask_type not in new_data.mask_images.keys():
-                new_data.mask_images[mask_type] = new_mask_images[mask_type]
-            else:
-                new_data.mask_images[mask_type] += new_mask_images[mask_type]
+            pos = self._random_position(new_data.shape)
+        new_data.lineage = data.lineage + [{"stage": "patch", "index": index, "pos": list(pos)}]
+        self._paste_masks(new_data, pos)
+        return new_data, pos
+
+    def apply_to_image_data_blend(self, data: ImageData, pos: tuple = None, mode: str = "SEAMLESS",
+                                  blend_radius: int = 4) -> ImageData:
+        """
+        只把h及其周围blend_radius像素的区域融合到原图上，其余部分保留原图
+        SEAMLESS: 泊松融合(MIXED_CLONE)，只在该区域的包围盒内求解
+        FEATHER: 边缘羽化的透明度混合，最快
+        MULTIBAND: 拉普拉斯金字塔融合，过渡比FEATHER自然
+        """
+        if mode == "NORMAL":
+            raise ValueError(f"无效的融合方式: {mode}")
+        new_data, pos = self._create_patched_data(data, pos)
+        self._paste_image(new_data.image, pos, mode, blend_radius=blend_radius)
         return new_data
 
     def apply_to_image_data_normal(self, data: ImageData, pos: tuple = None, delete_bg: bool = False) -> ImageData:
-        # 需要使用copy来解决引用问题
-        new_data = ImageData(data.name + f"_patch[{next(patch_counter)}]", data.image.copy(), None)
-        new_data.mask_images = data.mask_images.copy()
-        if pos is None:
-            # 如果没指定位置，则随机取点，取的点要保证能放下一个patch
-            pos = (randint(0, new_data.shape[0] - self.shape[0]),
-                   randint(0, new_data.shape[1] - self.shape[1]))
-        # 把patch的图片覆盖到原图指定位置上
-        if not delete_bg:
-            new_data.image[pos[0]:pos[0] + self.shape[0], pos[1]:pos[1] + self.shape[1], :] = self.image
-        else:
-            for mask in self.mask_images["h"]:
-                Xs, Ys = numpy.where(mask == 255)
-                for index in range(len(Xs)):
-                    x = Xs[index]
-                    y = Ys[index]
-                    new_data.image[pos[0] + x, pos[1] + y] = self.image[x, y]
-        # 把mask从小的变换到大坐标系中
-        new_mask_images = dict()
-        empty_mask = numpy.zeros((data.image.shape[0], data.image.shape[1]), dtype="uint8")
-        for mask_type in self.mask_images.keys():
-            new_mask_images[mask_type] = []
-            for mask_index in range(len(self.mask_images[mask_type])):
-                cur_big_mask = empty_mask.copy()
-                cur_big_mask[pos[0]:pos[0] + self.shape[0], pos[1]:pos[1] + self.shape[1]] = \
-                    self.mask_images[mask_type][mask_index]
-                new_mask_images[mask_type].append(cur_big_mask)
-        # 把mask也贴到原图上
-        for mask_type in new_mask_images.keys():
-            if mask_type not in new_data.mask_images.keys():
-                new_data.mask_images[mask_type] = new_mask_images[mask_type]
-            else:
-                new_data.mask_images[mask_type] += new_mask_images[mask_type]
+        new_data, pos = self._create_patched_data(data, pos)
+        self._paste_image(new_data.image, pos, "NORMAL", delete_bg)
         return new_data
 
     def drop_empty_masks(self):
         """去掉空的mask"""
-        # TODO: 检查下面的语句是否正确
-        empty = numpy.zeros(self.shape, dtype="uint8")
         for mask_type in self.types:
-            self.mask_images[mask_type] = [mask for mask in self.mask_images[mask_type] if not (mask == empty).all()]
-
-
-def split_img(image: numpy.ndarray, size: tuple) -> list:
-    patches = []
-    for x in range(0, image.shape[0], size[0]):
-        for y in range(0, image.shape[1], size[1]):
-            patches.append(image[
-                           x:x + size[0],
-                           y:y + size[1],
-                           :
-                           ])
-    return patches
-
-
-def split_mask(mask: numpy.ndarray, size: tuple) -> list:
-    patches = []
-    for x in range(0, mask.shape[0], size[0]):
-        for y in range(0, mask.shape[1], size[1]):
-            patches.append(mask[
-                           x:x + size[0],
-                           y:y + size[1]
-                           ])
-
-    return patches
+            self.mask_images[mask_type] = [mask for mask in self.mask_images[mask_type] if not mask.is_empty()]
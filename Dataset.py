@@ -0,0 +1,188 @@
+"""
+不写入磁盘，在训练时按需生成增强后的样本
+用法:
+    from Dataset import AugDataset
+    from Loader import scan_source
+    from main import config
+
+    with AugDataset(scan_source(config["DataSource"]), config, cache_bytes=2 * 1024 ** 3) as dataset:
+        for epoch in range(100):
+            for sample in dataset.iterate(epoch, workers=8):
+                sample["image"], sample["instances"], sample["classes"]
+每个样本与LABELMAP导出的内容相同，epoch为0时与导出的结果完全相同
+"""
+import random
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from DataObj import ImageData
+from Pipeline import build_stages, get_seed, init_worker, load_source, seed_source
+
+
+class SourceCache:
+    """按最近使用的顺序在内存中保存解码后的源图片，总大小超过max_bytes时删除最久没有使用的"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # 文件名 -> (ImageData, 大小)
+        self.total = 0
+
+    @staticmethod
+    def get_size(data: ImageData) -> int:
+        # 内存映射的图片不占用进程的内存
+        size = 0 if isinstance(data.image, numpy.memmap) else data.image.nbytes
+        if data.rasterized:
+            size += sum(mask.bitmap.nbytes for mask_type in data.types for mask in data.mask_images[mask_type])
+        return size
+
+    def get(self, file_name: str) -> ImageData | None:
+        if file_name not in self.entries:
+            return None
+        self.entries.move_to_end(file_name)
+        return self.entries[file_name][0]
+
+    def put(self, file_name: str, data: ImageData):
+        size = self.get_size(data)
+        if size > self.max_bytes:
+            return
+        if file_name in self.entries:
+            self.total -= self.entries.pop(file_name)[1]
+        self.entries[file_name] = (data, size)
+        self.total += size
+        while self.total > self.max_bytes:
+            _, (_, removed) = self.entries.popitem(last=False)
+            self.total -= removed
+
+
+def to_sample(data: ImageData, class_ids: dict) -> dict:
+    """把一块ImageData转换为训练用的样本，内容与LABELMAP格式导出的相同，lineage与Index中的相同"""
+    instances, classes = data.get_label_maps(class_ids)
+    return {"name": data.name, "lineage": data.lineage, "image": data.image, "instances": instances,
+            "classes": classes}
+
+
+class AugDataset:
+    """
+    按照config中AUG、SPLIT、PATCH的配置，按需生成每张源图片的所有样本
+    每张源图片在每个epoch中的结果只和SEED、epoch有关，与进程数量、读取顺序无关
+    """
+
+    def __init__(self, file_names: list, config: dict, cache_bytes: int = 0):
+        """
+        :param file_names: DataSource中的图片文件名，见Loader.scan_source
+        :param config: main.py中的配置
+        :param cache_bytes: 每个进程中最多缓存多少字节解码后的源图片，为0时不缓存
+        """
+        self.file_names = list(file_names)
+        self.config = config
+        self.cache_bytes = cache_bytes
+        self.cache = SourceCache(cache_bytes) if cache_bytes > 0 else None
+        self.epoch = 0
+        self.pools = []  # 每个进程一个只有一个进程的进程池，所有epoch共用，见get_pools
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """关闭进程池，之后再调用iterate时会重新创建"""
+        for pool in self.pools:
+            pool.shutdown(cancel_futures=True)
+        self.pools = []
+
+    def get_pools(self, workers: int) -> list:
+        """
+        按需创建workers个进程，之后的每个epoch都使用同一批进程，进程中的SourceCache和Patch库会一直保留
+        workers改变时重新创建
+        """
+        if len(self.pools) != workers:
+            self.close()
+            self.pools = [ProcessPoolExecutor(1, initializer=_init_dataset_worker,
+                                              initargs=(self.file_names, self.config, self.cache_bytes))
+                          for _ in range(workers)]
+        return self.pools
+
+    def __len__(self) -> int:
+        """源图片的数量，每张源图片会生成多个样本"""
+        return len(self.file_names)
+
+    def set_epoch(self, epoch: int):
+        """设置直接迭代(for sample in dataset)时使用的epoch"""
+        self.epoch = epoch
+
+    def iter_samples(self, index: int, epoch: int = 0):
+        """依次生成第index张源图片在该epoch中的所有样本，没有mask的块会被跳过(与导出时相同)"""
+        file_name = self.file_names[index]
+        seed_source(file_name, self.config, epoch)
+        source = self.cache.get(file_name) if self.cache is not None else None
+        if source is None:
+            source = load_source(file_name, self.config)
+        for data in build_stages(source, self.config):
+            if data.mask_count > 0:
+                yield to_sample(data, self.config["CLASS_IDS"])
+        # 处理完再放入缓存，此时需要的mask已经生成，大小是准确的
+        if self.cache is not None:
+            self.cache.put(file_name, source)
+
+    def get_samples(self, index: int, epoch: int = 0) -> list:
+        return list(self.iter_samples(index, epoch))
+
+    def get_order(self, epoch: int, shuffle: bool = True) -> list:
+        """该epoch中源图片的顺序，打乱时也是固定的"""
+        order = list(range(len(self)))
+        if shuffle:
+            random.Random(get_seed(self.config["SEED"], f"shuffle:{epoch}")).shuffle(order)
+        return order
+
+    def iterate(self, epoch: int = 0, shuffle: bool = True, workers: int = 1, max_in_flight: int = None):
+        """
+        生成该epoch的所有样本，顺序固定，与workers无关
+        :param workers: 生成样本的进程数，为1时在当前进程中生成
+            进程在第一次使用时创建，之后的epoch继续使用，用完后需要调用close(或者使用with)
+            每张源图片每个epoch都交给同一个进程，这样该进程的SourceCache才能在之后的epoch中命中
+        :param max_in_flight: 同时交给进程池的最大源图片数，用于限制内存占用，默认为2*workers
+        """
+        order = self.get_order(epoch, shuffle)
+        if workers <= 1:
+            for index in order:
+                yield from self.iter_samples(index, epoch)
+            return
+        max_in_flight = max(max_in_flight or 2 * workers, workers)
+        pools = self.get_pools(workers)
+        tasks = iter(order)
+        pending = []
+        try:
+            while True:
+                while len(pending) < max_in_flight:
+                    index = next(tasks, None)
+                    if index is None:
+                        break
+                    pending.append(pools[index % workers].submit(_get_samples, index, epoch))
+                if not pending:
+                    break
+                # 按提交的顺序返回，保证顺序固定
+                yield from pending.pop(0).result()
+        finally:
+            # 提前停止迭代时取消还没有开始的任务，进程保留给下一个epoch
+            for future in pending:
+                future.cancel()
+
+    def __iter__(self):
+        return self.iterate(self.epoch)
+
+
+_dataset: AugDataset | None = None  # 进程池中每个进程自己的AugDataset
+
+
+def _init_dataset_worker(file_names: list, config: dict, cache_bytes: int):
+    global _dataset
+    init_worker(config)
+    _dataset = AugDataset(file_names, config, cache_bytes)
+
+
+def _get_samples(index: int, epoch: int) -> list:
+    return _dataset.get_samples(index, epoch)
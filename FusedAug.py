@@ -0,0 +1,154 @@
+"""
+DataAug.get_aug_seqs中各个序列的快速实现，不依赖imgaug
+仿射变换只调用一次cv2.warpAffine，所有多边形的点只需要一次矩阵乘法
+相邻的逐像素操作(Add、Multiply)合并为一个查找表，只遍历一次图片
+随机参数的分布与imgaug相同，但使用的随机数不同，所以结果只在统计上与imgaug相同
+所有随机数都来自调用时传入的numpy.random.RandomState，多个序列可以在不同线程中同时运行
+"""
+import math
+
+import cv2
+import numpy
+
+
+def sample_affine(rng: numpy.random.RandomState, shape: tuple, scale: tuple, translate_percent: tuple,
+                  rotate: tuple) -> numpy.ndarray:
+    """
+    与iaa.Affine相同，随机生成绕图片中心的缩放(每个轴独立)、旋转和平移
+    :param shape: 图片的(高度, 长度)
+    :return: 2x3的矩阵，作用于多边形使用的连续坐标(像素i的中心为i + 0.5)
+    """
+    height, width = shape[0:2]
+    scale_x, scale_y = rng.uniform(scale[0], scale[1], 2)
+    translate_x = rng.uniform(translate_percent[0], translate_percent[1]) * width
+    translate_y = rng.uniform(translate_percent[0], translate_percent[1]) * height
+    angle = math.radians(rng.uniform(rotate[0], rotate[1]))
+    cos, sin = math.cos(angle), math.sin(angle)
+    linear = numpy.array([[scale_x * cos, -scale_y * sin],
+                          [scale_x * sin, scale_y * cos]])
+    center = numpy.array([width / 2, height / 2])
+    # 先移到中心，缩放旋转后再移回并平移
+    offset = center + (translate_x, translate_y) - linear @ center
+    return numpy.hstack([linear, offset[:, None]])
+
+
+def to_pixel_matrix(matrix: numpy.ndarray) -> numpy.ndarray:
+    """把作用于连续坐标的矩阵转换为cv2.warpAffine使用的矩阵(像素i的中心为i)"""
+    result = matrix.copy()
+    result[:, 2] += matrix[:, 0:2] @ (0.5, 0.5) - 0.5
+    return result
+
+
+def add(value: tuple, per_channel: float = 0):
+    """与iaa.Add相同，per_channel为每个通道使用不同值的概率"""
+    def sample(rng: numpy.random.RandomState, channels: int):
+        size = channels if rng.random_sample() < per_channel else 1
+        values = rng.randint(value[0], value[1] + 1, size)
+        return "lut", numpy.arange(256)[:, None] + numpy.broadcast_to(values, (1, channels))
+    return sample
+
+
+def multiply(value: tuple, per_channel: float = 0):
+    """与iaa.Multiply相同，per_channel为每个通道使用不同值的概率"""
+    def sample(rng: numpy.random.RandomState, channels: int):
+        size = channels if rng.random_sample() < per_channel else 1
+        values = rng.uniform(value[0], value[1], size)
+        return "lut", numpy.arange(256)[:, None] * numpy.broadcast_to(values, (1, channels))
+    return sample
+
+
+def gaussian_blur(sigma: tuple):
+    """与iaa.GaussianBlur相同"""
+    def sample(rng: numpy.random.RandomState, channels: int):
+        cur_sigma = rng.uniform(sigma[0], sigma[1])
+        if cur_sigma < 0.01:
+            return "filter", None
+        return "filter", lambda image: cv2.GaussianBlur(image, (0, 0), cur_sigma)
+    return sample
+
+
+def average_blur(k: tuple):
+    """与iaa.AverageBlur相同"""
+    def sample(rng: numpy.random.RandomState, channels: int):
+        cur_k = rng.randint(k[0], k[1] + 1)
+        return "filter", lambda image: cv2.blur(image, (cur_k, cur_k))
+    return sample
+
+
+def median_blur(k: tuple):
+    """与iaa.MedianBlur相同，偶数的核大小会加1"""
+    def sample(rng: numpy.random.RandomState, channels: int):
+        cur_k = rng.randint(k[0], k[1] + 1)
+        cur_k += 1 - cur_k % 2
+        return "filter", lambda image: cv2.medianBlur(image, cur_k)
+    return sample
+
+
+def one_of(steps: list):
+    """与iaa.OneOf相同，随机选择其中一个"""
+    def sample(rng: numpy.random.RandomState, channels: int):
+        return steps[rng.randint(len(steps))](rng, channels)
+    return sample
+
+
+class FusedSeq:
+    """
+    一个仿射变换加上之后的若干步操作，每次调用重新随机生成所有参数
+    每一步是一个函数，输入随机状态和通道数，返回("lut", 256x通道数的查找表)或者("filter", 处理图片的函数或None)
+    """
+
+    def __init__(self, affine: dict, steps: list):
+        """
+        :param affine: sample_affine的参数scale、translate_percent、rotate
+        :param steps: 仿射变换之后依次进行的操作，见add、multiply、gaussian_blur等
+        """
+        self.affine = affine
+        self.steps = steps
+
+    def __call__(self, image: numpy.ndarray, points: numpy.ndarray, rng: numpy.random.RandomState) -> tuple:
+        """
+        :param image: uint8图片
+        :param points: 所有多边形的点(N, 2)，见Utils.pack_polygons
+        :param rng: 这一次使用的随机状态
+        :return: (增强后的图片, 变换后的点)
+        """
+        matrix = sample_affine(rng, image.shape, **self.affine)
+        channels = image.shape[2] if image.ndim == 3 else 1
+        ops = [step(rng, channels) for step in self.steps]
+        result = cv2.warpAffine(image, to_pixel_matrix(matrix), (image.shape[1], image.shape[0]),
+                                flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        table = None
+        for kind, op in ops:
+            if kind == "lut":
+                # 连续的查找表合并为一个，每一步的结果都要截断到0-255
+                op = numpy.clip(numpy.rint(op), 0, 255).astype("uint8")
+                table = op if table is None else numpy.take_along_axis(op, table, axis=0)
+                continue
+            result = apply_table(result, table)
+            table = None
+            if op is not None:
+                result = op(result)
+        result = apply_table(result, table)
+        return result, points @ matrix[:, 0:2].T + matrix[:, 2]
+
+
+def apply_table(image: numpy.ndarray, table: numpy.ndarray | None) -> numpy.ndarray:
+    """用256x通道数的查找表处理uint8图片，table为None时直接返回"""
+    if table is None:
+        return image
+    if image.ndim == 2 or (table == table[:, 0:1]).all():
+        # 所有通道相同时单通道的查找表更快
+        return cv2.LUT(image, numpy.ascontiguousarray(table[:, 0]))
+    return cv2.LUT(image, table.reshape(256, 1, -1))
+
+
+def get_fused_seqs() -> list:
+    """与DataAug.get_aug_seqs中的序列一一对应，修改其中一个时另一个也需要修改"""
+    affine = dict(scale=(0.8, 1.2), translate_percent=(-0.2, 0.2), rotate=(-45, 45))
+    return [
+        FusedSeq(affine, []),
+        FusedSeq(affine, [add((-10, 10), per_channel=0.5), gaussian_blur((0, 3.0))]),
+        FusedSeq(affine, [one_of([gaussian_blur((0, 3.0)), median_blur((3, 11)), add((-10, 10), per_channel=0.5)])]),
+        FusedSeq(affine, [one_of([gaussian_blur((0, 3.0)), average_blur((2, 7)), median_blur((3, 11))]),
+                          multiply((0.5, 1.5), per_channel=0.5)]),
+    ]
@@ -0,0 +1,54 @@
+import json
+import os
+import random
+from os import path
+
+INDEX_NAME = "index.jsonl"
+VALS_NAME = "VALs.txt"
+
+
+def select_vals(samples: list, val_rate: float, seed: int, group_by_source: bool = True) -> list:
+    """
+    按固定种子从所有样本中随机选择VAL，samples的顺序需要是确定的
+    :param samples: Index中的样本，每一项至少有"name"和"source"
+    :param group_by_source: 为True时以源图片为单位选择，同一张源图片的所有块都在TRAIN或者都在VAL中，
+        选到的样本数量会略多于len(samples) * val_rate
+    :return: VAL样本的名称，按选择的顺序排列
+    """
+    rng = random.Random(seed)
+    amount = int(len(samples) * val_rate)
+    if not group_by_source:
+        return [sample["name"] for sample in rng.sample(samples, amount)]
+    groups = dict()  # 源图片 -> 它的所有样本名称，保持samples中的顺序
+    for sample in samples:
+        groups.setdefault(sample["source"], []).append(sample["name"])
+    sources = list(groups.keys())
+    rng.shuffle(sources)
+    vals = []
+    for source in sources:
+        if len(vals) >= amount:
+            break
+        vals += groups[source]
+    return vals
+
+
+def write_index(target_path: str, samples: list, vals: list):
+    """
+    把所有样本写入target_path/index.jsonl，每行一个样本：
+    {"name": 名称, "source": 源图片, "lineage": 经过的处理, "files": [相对于target_path的文件], "val": 是否为VAL}
+    同时把VAL的名称按行写入VALs.txt
+    """
+    val_set = set(vals)
+    temp_path = path.join(target_path, INDEX_NAME + ".tmp")
+    with open(temp_path, mode="w", encoding="utf-8") as file:
+        for sample in samples:
+            file.write(json.dumps(dict(sample, val=sample["name"] in val_set), ensure_ascii=False) + "\n")
+    os.replace(temp_path, path.join(target_path, INDEX_NAME))
+    with open(path.join(target_path, VALS_NAME), mode="w", encoding="utf-8") as file:
+        file.writelines(name + "\n" for name in vals)
+
+
+def read_index(target_path: str) -> list:
+    """读取write_index写入的所有样本"""
+    with open(path.join(target_path, INDEX_NAME), mode="r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from DataObj import ImageData
+from Utils import get_json_name, get_sample_name
+
+IMAGE_EXTENSIONS = (".jpg", ".png")
+
+
+def scan_source(source_path: str, recursive: bool = True) -> list:
+    """
+    找出source_path中所有有同名labelme json的图片，没有json的图片和没有图片的json会被输出并跳过
+    :param recursive: 是否同时扫描子文件夹
+    :return: 相对于source_path的图片路径，按路径排序
+    """
+    images = []
+    jsons = set()
+    for folder, folder_names, file_names in os.walk(source_path):
+        folder_names.sort()
+        if not recursive:
+            folder_names.clear()
+        for name in file_names:
+            relative = path.relpath(path.join(folder, name), source_path)
+            extension = path.splitext(name)[1].lower()
+            if extension in IMAGE_EXTENSIONS:
+                images.append(relative)
+            elif extension == ".json":
+                jsons.add(relative)
+    images.sort()
+
+    result = []
+    names = dict()  # 输出名称 -> 图片，不同图片的输出名称不能相同
+    for image in images:
+        json_name = get_json_name(image)
+        if json_name not in jsons:
+            print(f"图片 {image} 没有对应的json文件 {json_name}，跳过")
+            continue
+        jsons.discard(json_name)
+        name = get_sample_name(image)
+        if name in names:
+            raise ValueError(f"图片 {names[name]} 和 {image} 的输出名称都是 {name}，请重命名其中一个")
+        names[name] = image
+        result.append(image)
+    for json_name in sorted(jsons):
+        print(f"json文件 {json_name} 没有对应的图片，跳过")
+    return result
+
+
+class PrefetchLoader:
+    """
+    在后台线程中提前读取并解码之后的图片，按顺序返回(文件名, ImageData)
+    解码(cv2.imdecode)时不占用GIL，所以读取下一张图片可以与当前图片的处理同时进行
+    可以配合with使用，退出时会取消还没有开始的读取
+    """
+
+    def __init__(self, file_names: list, source_path: str, cache=None, prefetch: int = 4, threads: int = 2):
+        """
+        :param file_names: 需要读取的图片，相对于source_path
+        :param cache: Cache.DecodeCache，为None时不使用缓存
+        :param prefetch: 最多提前读取多少张图片，为0时在调用的线程中依次读取
+        :param threads: 读取使用的线程数
+        """
+        self.file_names = list(file_names)
+        self.source_path = source_path
+        self.cache = cache
+        self.prefetch = prefetch
+        self.pool = ThreadPoolExecutor(max(threads, 1)) if prefetch > 0 else None
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load(self, file_name: str) -> ImageData:
+        return ImageData.create_from_file(file_name, self.source_path, self.cache)
+
+    def __iter__(self):
+        if self.pool is None:
+            for file_name in self.file_names:
+                yield file_name, self._load(file_name)
+            return
+        tasks = iter(self.file_names)
+        for file_name in tasks:
+            self.futures.append((file_name, self.pool.submit(self._load, file_name)))
+            if len(self.futures) >= self.prefetch:
+                break
+        while self.futures:
+            file_name, future = self.futures.pop(0)
+            # 取走一张就补充一张，读取出错时在轮到这张图片时抛出
+            next_name = next(tasks, None)
+            if next_name is not None:
+                self.futures.append((next_name, self.pool.submit(self._load, next_name)))
+            yield file_name, future.result()
+
+    def __len__(self) -> int:
+        return len(self.file_names)
+
+    def close(self):
+        for _, future in self.futures:
+            future.cancel()
+        self.futures = []
+        if self.pool is not None:
+            self.pool.shutdown()
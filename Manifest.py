@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import shutil
+from os import path
+
+from Utils import get_json_name
+
+MANIFEST_NAME = "manifest.jsonl"
+# 相同配置下导出的内容改变时(例如栅格化或随机数的使用方式改变)需要增加，使之前处理过的图片重新处理
+OUTPUT_VERSION = 2
+# 会影响输出结果的配置，其它配置(进程数、写入线程数等)改变时不需要重新处理
+OUTPUT_CONFIG_KEYS = ("AUG", "AUG_BACKEND", "SPLIT", "SPLIT_STRIDE", "SPLIT_PAD", "POLYGON_MODE", "SPLIT_WINDOWED",
+                      "PATCH", "PATCH_AMOUNT", "PATCH_MODE", "PATCH_BLEND_RADIUS", "PATCH_ALLOW_OVERLAP",
+                      "PATCH_MAX_TRIES", "SEED", "OUTPUT_FORMAT", "CLASS_IDS", "PNG_COMPRESSION")
+
+
+def get_file_hash(file_path: str, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(file_path, mode="rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher
+
+
+def get_config_hash(config: dict) -> str:
+    """计算会影响输出的配置的哈希，使用Patch时Patch库中文件的名称和大小也算在内"""
+    hasher = hashlib.sha256(f"{OUTPUT_VERSION}:".encode("utf-8"))
+    hasher.update(json.dumps({key: config.get(key) for key in OUTPUT_CONFIG_KEYS}, sort_keys=True).encode("utf-8"))
+    if config.get("PATCH") and path.isdir(config["PATCH_PATH"]):
+        for name in sorted(os.listdir(config["PATCH_PATH"])):
+            hasher.update(f"{name}:{path.getsize(path.join(config['PATCH_PATH'], name))}".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_source_hash(file_name: str, source_path: str, config_hash: str) -> str:
+    """源图片、同名json和配置共同的哈希，任何一个改变都需要重新处理"""
+    hasher = hashlib.sha256(config_hash.encode("utf-8"))
+    get_file_hash(path.join(source_path, file_name), hasher)
+    get_file_hash(path.join(source_path, get_json_name(file_name)), hasher)
+    return hasher.hexdigest()
+
+
+def remove_outputs(target_path: str, names: list, output_format: str):
+    """删除之前导出的文件"""
+    for name in names:
+        if output_format == "MASKS":
+            shutil.rmtree(path.join(target_path, name), ignore_errors=True)
+        elif output_format == "LABELMAP":
+            for folder in ("images", "instances", "classes"):
+                if path.exists(path.join(target_path, folder, name + ".png")):
+                    os.remove(path.join(target_path, folder, name + ".png"))
+        elif output_format == "NPZ":
+            if path.exists(path.join(target_path, name + ".npz")):
+                os.remove(path.join(target_path, name + ".npz"))
+
+
+class Manifest:
+    """
+    记录Target中每张源图片的处理结果，用于增量处理和中断后继续
+    每处理完一张图片就在文件末尾追加一行，同一张图片以最后一行为准，所以中途崩溃也不会丢失已完成的记录
+    每一行的格式为 {"file": 源图片文件名, "hash": 哈希, "format": 导出格式, "samples": [导出的样本]}
+    每个样本为 {"name": 名称, "lineage": 经过的处理, "files": [导出的文件]}，用于生成Index
+    """
+
+    def __init__(self, target_path: str):
+        self.target_path = target_path
+        self.file_path = path.join(target_path, MANIFEST_NAME)
+        self.entries = dict()
+        self.broken_tail = False  # 最后一行是否没有写完整，之后追加时需要先换行
+        if path.exists(self.file_path):
+            with open(self.file_path, mode="r", encoding="utf-8") as file:
+                for line in file:
+                    self.broken_tail = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时最后一行可能没有写完整
+                        continue
+                    if entry["hash"] is None:
+                        # 该图片的结果已经被删除
+                        self.entries.pop(entry["file"], None)
+                    else:
+                        self.entries[entry["file"]] = entry
+
+    def is_done(self, file_name: str, source_hash: str) -> bool:
+        # 旧版本的记录中没有samples，需要重新处理才能生成Index
+        return file_name in self.entries and self.entries[file_name]["hash"] == source_hash \
+            and "samples" in self.entries[file_name]
+
+    def get_outputs(self, file_name: str) -> list:
+        """该源图片导出的所有样本名称"""
+        if file_name not in self.entries:
+            return []
+        entry = self.entries[file_name]
+        if "samples" not in entry:
+            return entry["outputs"]
+        return [sample["name"] for sample in entry["samples"]]
+
+    def get_samples(self, file_name: str) -> list:
+        """该源图片导出的所有样本，每个样本加上了"source"，见Index.write_index"""
+        if file_name not in self.entries:
+            return []
+        return [dict(sample, source=file_name) for sample in self.entries[file_name].get("samples", [])]
+
+    def remove(self, file_name: str):
+        """删除该源图片之前导出的文件，并从记录中去掉"""
+        if file_name not in self.entries:
+            return
+        remove_outputs(self.target_path, self.get_outputs(file_name), self.entries[file_name]["format"])
+        entry = self.entries.pop(file_name)
+        self._append({"file": file_name, "hash": None, "format": entry["format"], "samples": []})
+
+    def prune(self, file_names: list) -> list:
+        """
+        删除不在file_names中的源图片(已经从DataSource中删除或移走)之前导出的文件和记录
+        :return: 被删除的源图片
+        """
+        keep = set(file_names)
+        removed = [file_name for file_name in sorted(self.entries.keys()) if file_name not in keep]
+        for file_name in removed:
+            self.remove(file_name)
+        return removed
+
+    def mark_done(self, file_name: str, source_hash: str, output_format: str, samples: list):
+        entry = {"file": file_name, "hash": source_hash, "format": output_format, "samples": samples}
+        self.entries[file_name] = entry
+        self._append(entry)
+
+    def _append(self, entry: dict):
+        with open(self.file_path, mode="a", encoding="utf-8") as file:
+            if self.broken_tail:
+                # 不换行的话这一行会和没写完整的那一行连在一起，读取时一起被丢弃
+                file.write("\n")
+                self.broken_tail = False
+            file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def compact(self):
+        """重新写入文件，每张图片只保留一行，按文件名排序"""
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, mode="w", encoding="utf-8") as file:
+            for file_name in sorted(self.entries.keys()):
+                entry = self.entries[file_name]
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.file_path)
@@ -0,0 +1,170 @@
+import sys
+import threading
+import time
+
+
+def get_max_rss() -> int | None:
+    """进程的最大常驻内存(字节)，不支持的系统返回None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS的单位是字节，Linux是KB
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class _NullTimer:
+    """关闭统计时使用的计时器，什么都不做"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, stage: str):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """
+    记录各阶段的耗时、计数和内存峰值
+    enabled为False时所有方法都直接返回，几乎没有额外开销
+    每个进程有一个当前的Metrics(见get_metrics)，子进程的结果用to_dict传回主进程后merge
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.timers = dict()  # 阶段名: [总秒数, 次数]
+        self.counters = dict()
+        self.max_rss = 0
+        self.lock = threading.Lock()  # 写入线程也会记录耗时
+
+    def timer(self, stage: str):
+        """用于with的计时器，退出时把耗时记录到stage"""
+        return _Timer(self, stage) if self.enabled else NULL_TIMER
+
+    def add_time(self, stage: str, seconds: float, count: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            cur = self.timers.setdefault(stage, [0.0, 0])
+            cur[0] += seconds
+            cur[1] += count
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, iterable, stage: str):
+        """
+        包装一个迭代器，把每次生成下一项的耗时记录到stage
+        用于生成器串联的阶段，这样只记录该阶段自己的耗时，不包括上游阶段
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed(iterable, stage)
+
+    def _timed(self, iterable, stage: str):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start, 0)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def update_memory(self):
+        """记录当前进程的内存峰值"""
+        if not self.enabled:
+            return
+        self.max_rss = max(self.max_rss, get_max_rss() or 0)
+
+    def to_dict(self) -> dict:
+        self.update_memory()
+        return {
+            "timers": {stage: {"seconds": seconds, "count": count}
+                       for stage, (seconds, count) in sorted(self.timers.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "max_rss_bytes": self.max_rss,
+        }
+
+    def merge(self, other: dict):
+        """合并另一个Metrics.to_dict的结果，耗时和计数相加，内存峰值取最大值"""
+        if not self.enabled or other is None:
+            return
+        for stage, timer in other["timers"].items():
+            self.add_time(stage, timer["seconds"], timer["count"])
+        for name, amount in other["counters"].items():
+            self.count(name, amount)
+        self.max_rss = max(self.max_rss, other["max_rss_bytes"])
+
+    def report(self) -> str:
+        """生成便于阅读的汇总文本"""
+        lines = ["各阶段耗时(所有进程相加):"]
+        for stage, (seconds, count) in sorted(self.timers.items(), key=lambda item: -item[1][0]):
+            lines.append(f"  {stage}: {seconds:.2f}s，共{count}次")
+        lines.append("计数:")
+        for name, amount in sorted(self.counters.items()):
+            lines.append(f"  {name}: {amount}")
+        lines.append(f"单个进程的最大内存: {self.max_rss / 1024 ** 2:.1f}MB")
+        return "\n".join(lines)
+
+
+class Progress:
+    """每隔interval秒输出一次进度和预计剩余时间，interval为None时不输出"""
+
+    def __init__(self, total: int, interval: float | None):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, amount: int = 1):
+        self.done += amount
+        if self.interval is None:
+            return
+        now = time.perf_counter()
+        if now - self.last_report < self.interval and self.done < self.total:
+            return
+        self.last_report = now
+        elapsed = now - self.start
+        remaining = elapsed / self.done * (self.total - self.done) if self.done else 0
+        print(f"进度: {self.done}/{self.total} ({self.done / max(self.total, 1):.1%})，"
+              f"已用时{elapsed:.1f}s，预计还需{remaining:.1f}s")
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """当前进程正在使用的Metrics"""
+    return _metrics
+
+
+def reset_metrics(enabled: bool) -> Metrics:
+    """为当前进程创建新的Metrics，每张源图片开始处理时调用，这样子进程只需要传回这张图片的结果"""
+    global _metrics
+    _metrics = Metrics(enabled)
+    return _metrics
@@ -0,0 +1,164 @@
+"""
+Patch库的打包格式（.patchpack），用于代替每个Patch一个的pickle文件
+
+文件结构：
+    文件头  MAGIC(8字节) + 版本号(uint32) + 4字节空白
+    数据区  所有Patch的图片和mask位图，每块都按ALIGN字节对齐，直接保存原始数组
+    索引    utf-8编码的json，记录每个Patch的图片和mask在数据区中的位置与形状
+    文件尾  索引的位置(uint64) + 索引的长度(uint64) + MAGIC(8字节)
+
+因为索引在文件尾，所以可以一边生成Patch一边写入；读取时用numpy.memmap映射整个文件，
+图片和mask都是映射上的视图，不需要复制，多个进程读取同一个文件时也会共享内存
+"""
+import json
+import os
+import struct
+import sys
+from os import path
+
+import numpy
+
+from DataObj import Mask, Patch
+
+MAGIC = b"PATCHPK\0"
+VERSION = 1
+ALIGN = 64
+EXTENSION = ".patchpack"
+HEADER = struct.Struct("<8sI4x")
+FOOTER = struct.Struct("<QQ8s")
+
+
+class PatchArchiveWriter:
+    """
+    逐个写入Patch，最后调用close写入索引
+    可以配合with使用
+    """
+
+    def __init__(self, target_path: str):
+        self.target_path = target_path
+        self.file = open(target_path, mode="wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _write_array(self, array: numpy.ndarray) -> dict:
+        """把数组对齐后写入数据区，返回它在索引中的描述"""
+        padding = -self.file.tell() % ALIGN
+        self.file.write(b"\0" * padding)
+        array = numpy.ascontiguousarray(array)
+        offset = self.file.tell()
+        self.file.write(array.tobytes())
+        return {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+
+    def write(self, patch: Patch):
+        masks = dict()
+        for mask_type in patch.types:
+            masks[mask_type] = []
+            for mask in patch.mask_images[mask_type]:
+                cur_mask = self._write_array(mask.bitmap)
+                cur_mask["pos"] = [int(mask.offset[0]), int(mask.offset[1])]
+                masks[mask_type].append(cur_mask)
+        self.index.append({"image": self._write_array(patch.image), "masks": masks})
+
+    def close(self):
+        if self.file.closed:
+            return
+        index = json.dumps({"version": VERSION, "patches": self.index}).encode("utf-8")
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        self.file.close()
+
+
+def write_archive(patches: list, target_path: str) -> int:
+    """
+    把所有Patch写入一个打包文件
+    :return: 写入的Patch数量
+    """
+    with PatchArchiveWriter(target_path) as writer:
+        for patch in patches:
+            writer.write(patch)
+        return len(writer)
+
+
+def _get_array(data: numpy.ndarray, info: dict) -> numpy.ndarray:
+    dtype = numpy.dtype(info["dtype"])
+    size = int(numpy.prod(info["shape"])) * dtype.itemsize
+    return data[info["offset"]:info["offset"] + size].view(dtype).reshape(info["shape"])
+
+
+def read_archive(source_path: str, mmap: bool = True) -> list:
+    """
+    读取打包文件中的所有Patch
+    :param mmap: 为True时使用内存映射，Patch中的数组都是只读的文件视图；为False时一次性读入内存
+    """
+    with open(source_path, mode="rb") as file:
+        magic, version = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{source_path} 不是Patch打包文件")
+        if version > VERSION:
+            raise ValueError(f"{source_path} 的版本为{version}，只支持{VERSION}及以下的版本")
+        file.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = FOOTER.unpack(file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{source_path} 不完整，可能没有正常写入结束")
+        file.seek(index_offset)
+        index = json.loads(file.read(index_length).decode("utf-8"))
+
+    if mmap:
+        data = numpy.memmap(source_path, dtype="uint8", mode="r", shape=(index_offset,))
+    else:
+        data = numpy.fromfile(source_path, dtype="uint8", count=index_offset)
+    result = []
+    for info in index["patches"]:
+        image = _get_array(data, info["image"])
+        mask_images = dict()
+        for mask_type, masks in info["masks"].items():
+            mask_images[mask_type] = [Mask(tuple(mask["pos"]), _get_array(data, mask), image.shape)
+                                      for mask in masks]
+        result.append(Patch(image, mask_images))
+    return result
+
+
+def load_patches(source_path: str, mmap: bool = True) -> list:
+    """
+    读取文件夹中的所有Patch，按文件名顺序读取打包文件(.patchpack)和旧的pickle文件(.patch)
+    """
+    result = []
+    for name in sorted(os.listdir(source_path)):
+        file_path = path.join(source_path, name)
+        if name.endswith(EXTENSION):
+            result += read_archive(file_path, mmap)
+        elif name.endswith(".patch"):
+            result += Patch.load_from_files([file_path])
+    return result
+
+
+def convert_folder(source_path: str, target_path: str) -> int:
+    """
+    把文件夹中旧的pickle格式Patch(.patch)转换为一个打包文件
+    :return: 转换的Patch数量
+    """
+    names = sorted(name for name in os.listdir(source_path) if name.endswith(".patch"))
+    with PatchArchiveWriter(target_path) as writer:
+        # 逐个读取，防止一次性读入所有Patch
+        for name in names:
+            for patch in Patch.load_from_files([path.join(source_path, name)]):
+                writer.write(patch)
+        return len(writer)
+
+
+if __name__ == "__main__":
+    # 用法: python PatchArchive.py 旧Patch文件夹 新文件.patchpack
+    if len(sys.argv) != 3:
+        print("用法: python PatchArchive.py 旧Patch文件夹 新文件.patchpack")
+        exit()
+    print(f"共转换了 {convert_folder(sys.argv[1], sys.argv[2])} 个Patch")
@@ -0,0 +1,87 @@
+import random
+
+from PatchArchive import load_patches
+
+
+class PatchLibrary:
+    """
+    Patch库，只在第一次使用时从文件夹读取一次，之后一直保存在内存中
+    同时按照大小、类型、mask数量建立索引，方便按条件随机选择
+    使用内存映射读取.patchpack时，所有进程共享同一份文件缓存
+    """
+
+    def __init__(self, source_path: str, mmap: bool = True):
+        self.source_path = source_path
+        self.mmap = mmap
+        # noinspection PyTypeChecker
+        self._patches: list = None
+        self.by_size = dict()  # (高度, 长度) -> [patch下标]
+        self.by_type = dict()  # mask类型 -> [patch下标]
+        self.by_mask_count = dict()  # 所有mask的数量 -> [patch下标]
+        self._selections = dict()  # 缓存select的结果
+
+    @property
+    def patches(self) -> list:
+        if self._patches is None:
+            self.load()
+        return self._patches
+
+    def load(self):
+        """读取所有Patch并建立索引，已经读取过的话什么都不做"""
+        if self._patches is not None:
+            return
+        self._patches = load_patches(self.source_path, self.mmap)
+        for index, patch in enumerate(self._patches):
+            self.by_size.setdefault(tuple(patch.shape), []).append(index)
+            mask_count = 0
+            for mask_type in patch.types:
+                if patch.mask_images[mask_type]:
+                    self.by_type.setdefault(mask_type, []).append(index)
+                mask_count += len(patch.mask_images[mask_type])
+            self.by_mask_count.setdefault(mask_count, []).append(index)
+
+    def __len__(self) -> int:
+        return len(self.patches)
+
+    def select(self, max_size: tuple = None, mask_type: str = None, min_masks: int = 0) -> list:
+        """
+        按条件选出Patch，结果按读取顺序排列并会被缓存
+        :param max_size: Patch的(高度, 长度)都不能超过它
+        :param mask_type: Patch中必须有该类型的mask
+        :param min_masks: Patch中mask的数量至少为多少
+        """
+        key = (None if max_size is None else tuple(max_size[0:2]), mask_type, min_masks)
+        if key == (None, None, 0):
+            return self.patches
+        if key not in self._selections:
+            indexes = set(range(len(self.patches)))
+            if max_size is not None:
+                indexes &= {i for size, cur in self.by_size.items()
+                            if size[0] <= max_size[0] and size[1] <= max_size[1] for i in cur}
+            if mask_type is not None:
+                indexes &= set(self.by_type.get(mask_type, []))
+            if min_masks > 0:
+                indexes &= {i for count, cur in self.by_mask_count.items() if count >= min_masks for i in cur}
+            self._selections[key] = [self.patches[i] for i in sorted(indexes)]
+        return self._selections[key]
+
+    def sample(self, amount: int, rng: random.Random = None, **conditions) -> list:
+        """
+        随机选出amount个满足条件的Patch，不足时返回空列表
+        :param rng: 使用的随机数生成器，默认为random模块
+        :param conditions: 传给select的条件
+        """
+        candidates = self.select(**conditions)
+        if len(candidates) < amount:
+            return []
+        return (rng or random).sample(candidates, amount)
+
+
+_libraries = dict()
+
+
+def get_patch_library(source_path: str, mmap: bool = True) -> PatchLibrary:
+    """每个进程中，同一个路径只会有一个Patch库"""
+    if source_path not in _libraries:
+        _libraries[source_path] = PatchLibrary(source_path, mmap)
+    return _libraries[source_path]
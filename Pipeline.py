@@ -0,0 +1,249 @@
+import gc
+import json
+import random
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from os import path
+
+import cv2
+import imgaug as ia
+import numpy
+
+import DataObj
+from Cache import DecodeCache
+from DataAug import iter_aug_data
+from DataObj import ImageData, Patch
+from Loader import PrefetchLoader
+from Manifest import Manifest, get_config_hash, get_source_hash
+from Metrics import Metrics, Progress, get_metrics, reset_metrics
+from PatchLib import PatchLibrary, get_patch_library
+from Utils import counter
+from Writer import AsyncWriter
+
+METRICS_NAME = "metrics.json"
+
+
+def get_seed(base_seed: int, file_name: str) -> int:
+    """
+    根据全局种子和文件名生成该图片自己的种子
+    这样输出只和输入有关，与进程数量、处理顺序无关
+    """
+    return zlib.crc32(f"{base_seed}:{file_name}".encode("utf-8"))
+
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    numpy.random.seed(seed)
+    ia.seed(seed)
+
+
+def seed_source(file_name: str, config: dict, epoch: int = 0):
+    """
+    处理一张源图片前设置随机种子并重新计数，保证结果只和图片、SEED、epoch有关，与进程和处理顺序无关
+    epoch为0时与导出的结果相同，epoch单独加入种子，不同SEED的各个epoch不会互相重复
+    """
+    seed_everything(get_seed(config["SEED"], file_name if epoch == 0 else f"{file_name}:{epoch}"))
+    # 每张图片重新计数，保证patch的命名与进程无关
+    DataObj.patch_counter = counter()
+
+
+def init_worker(config: dict):
+    """
+    进程池中每个进程启动时先读取Patch库，fork启动的进程会直接继承主进程中已读取的库
+    同时限制OpenCV在每个进程中使用的线程数，避免WORKERS个进程各自再开满所有核的线程互相争抢
+    """
+    cv2.setNumThreads(config["WORKER_CV_THREADS"])
+    if config["PATCH"]:
+        get_patch_library(config["PATCH_PATH"], config["PATCH_MMAP"]).load()
+
+
+def get_decode_cache(config: dict) -> DecodeCache | None:
+    """没有设置CACHE_PATH时返回None"""
+    if not config["CACHE_PATH"]:
+        return None
+    # 多边形模式下SPLIT只裁剪多边形，缓存栅格化后的mask反而需要多做一次栅格化
+    return DecodeCache(config["CACHE_PATH"], config["CACHE_MAX_BYTES"], not config["POLYGON_MODE"])
+
+
+def load_source(file_name: str, config: dict) -> ImageData:
+    """读取一张源图片，SPLIT_WINDOWED时以内存映射打开，见ImageData.open_from_file"""
+    if config["SPLIT_WINDOWED"]:
+        return ImageData.open_from_file(file_name, config["DataSource"], get_decode_cache(config))
+    return ImageData.create_from_file(file_name, config["DataSource"], get_decode_cache(config))
+
+
+def stage_aug(datas, backend: str = "IMGAUG", threads: int = 0):
+    """AUG阶段：每张图片依次生成各个增强序列的结果，threads大于0时各个序列在线程池中同时运行"""
+    for data in datas:
+        yield from get_metrics().timed(iter_aug_data(data, backend, threads), "aug")
+
+
+def stage_split(datas, size: tuple, stride: tuple = None, pad: bool = False, clip_polygons: bool = False):
+    """SPLIT阶段：把每张图片依次切开"""
+    metrics = get_metrics()
+    for data in datas:
+        for tile in metrics.timed(data.iter_split(size, stride, pad, clip_polygons), "split"):
+            metrics.count("tiles_produced")
+            yield tile
+
+
+def stage_patch(datas, patches: PatchLibrary, amount: int, mode: str, blend_radius: int = 4,
+                max_tries: int = 50, allow_overlap: bool = False):
+    """PATCH阶段：给每张图片贴上amount个Patch，默认避开已有的物体和已经贴上的Patch"""
+    # TODO：提供更高可自定义程度的贴图
+    # 如果新的贴图产生的ImageData中没有新增某一类型的细胞核，那么会导致重复，解决方法：只使用patched的图片
+    metrics = get_metrics()
+    for data_file in datas:
+        with metrics.timer("patch"):
+            # 只从能放进这张图的Patch中选择
+            cur_patches = patches.sample(amount, max_size=data_file.shape)
+            if not cur_patches:
+                print(f"能放进 {data_file.name} 的Patch数量小于PATCH_AMOUNT，该图不进行贴图")
+                metrics.count("tiles_unpatched")
+            else:
+                data_file = Patch.apply_patches_to_image_data(data_file, cur_patches, mode=mode,
+                                                              blend_radius=blend_radius, max_tries=max_tries,
+                                                              allow_overlap=allow_overlap)
+        yield data_file
+
+
+def build_stages(data: ImageData, config: dict):
+    """
+    按配置把各个阶段串联起来，返回一个生成器
+    每一块图片都会依次经过所有阶段，所以同时存在于内存中的只有少数几块
+    """
+    stream = iter([data, ])
+    if config["AUG"]:
+        stream = stage_aug(stream, config["AUG_BACKEND"], config["AUG_THREADS"])
+    if config["SPLIT"]:
+        #  print("注意：如果使用了SPLIT的话只会输出被分割后的图片")
+        # 按窗口读取时源图片的mask不能整张栅格化，只能裁剪多边形
+        stream = stage_split(stream, config["SPLIT"], config["SPLIT_STRIDE"], config["SPLIT_PAD"],
+                             config["POLYGON_MODE"] or config["SPLIT_WINDOWED"])
+    if config["PATCH"]:
+        stream = stage_patch(stream, get_patch_library(config["PATCH_PATH"], config["PATCH_MMAP"]),
+                             config["PATCH_AMOUNT"], config["PATCH_MODE"], config["PATCH_BLEND_RADIUS"],
+                             config["PATCH_MAX_TRIES"], config["PATCH_ALLOW_OVERLAP"])
+    return stream
+
+
+def process_source(file_name: str, config: dict, data: ImageData = None) -> tuple:
+    """
+    处理一张源图片：读取→AUG→SPLIT→PATCH→导出，每一块处理完后立刻导出并释放
+    :param file_name: DataSource中的图片文件名
+    :param config: main.py中的配置
+    :param data: 已经读取好的图片(见Loader.PrefetchLoader)，为None时在这里读取
+    :return: (成功导出的样本列表，每个样本为{"name", "lineage", "files"}，
+              这张图片的Metrics.to_dict，没有开启METRICS时为None)
+    """
+    seed_source(file_name, config)
+    metrics = reset_metrics(config["METRICS"])
+
+    print(f"\n\n开始处理图片: {file_name}")
+    if data is None:
+        with metrics.timer("decode"):
+            data = load_source(file_name, config)
+    cur_data: ImageData = data
+    del data
+    metrics.count("masks_loaded", cur_data.mask_count)
+
+    samples = []
+    # 退出with时会等待所有文件写完，所以返回的文件一定已经在磁盘上了
+    writer = AsyncWriter(config["WRITER_THREADS"], config["WRITER_MAX_PENDING"], config["PNG_COMPRESSION"], metrics)
+    with writer:
+        for j in build_stages(cur_data, config):
+            print(f"正在导出文件:\n{str(j)}")
+            with metrics.timer("dump"):
+                files = j.dump(config["DataTarget"], config["OUTPUT_FORMAT"], config["CLASS_IDS"], writer)
+            if files:
+                samples.append({"name": j.name, "lineage": j.lineage, "files": files})
+            else:
+                metrics.count("outputs_skipped")
+        with metrics.timer("writer_flush"):
+            writer.flush()
+    metrics.count("outputs_exported", len(samples))
+    metrics.count("files_written", writer.files_written)
+    metrics.count("bytes_written", writer.bytes_written)
+    del cur_data
+    gc.collect()
+    return samples, metrics.to_dict() if metrics.enabled else None
+
+
+def run_aug(pic_files: list, config: dict, manifest: Manifest) -> list | None:
+    """
+    把所有源图片分发到进程池中处理
+    同时提交的图片数量不超过MAX_IN_FLIGHT，防止占用过多内存
+    manifest中已经记录且源文件和配置都没有改变的图片会被跳过，每处理完一张就记录一张
+    manifest中有记录但已经不在pic_files中的图片，之前导出的文件和记录会被删除
+    开启METRICS时，各进程的统计结果会合并后保存到DataTarget中的metrics.json
+    :return: 按pic_files顺序排列的所有导出的样本(包括之前已经处理过的)，见Manifest.get_samples
+        配置无法执行而没有进行任何处理时返回None，此时不应该覆盖已有的Index
+    """
+    # 在主进程中读取一次Patch库，fork出的子进程可以直接共享
+    if config["PATCH"] and len(get_patch_library(config["PATCH_PATH"], config["PATCH_MMAP"])) < config["PATCH_AMOUNT"]:
+        print("有效Patch数量小于PATCH_AMOUNT，无法执行该项数据增强")
+        return None
+
+    removed = manifest.prune(pic_files)
+    if removed:
+        print(f"{len(removed)}张图片已经不在DataSource中，删除了它们之前导出的文件")
+    config_hash = get_config_hash(config)
+    hashes = dict()
+    todo = []
+    for file_name in pic_files:
+        hashes[file_name] = get_source_hash(file_name, config["DataSource"], config_hash)
+        if not manifest.is_done(file_name, hashes[file_name]):
+            # 源文件或配置改变了，之前的结果需要删除
+            manifest.remove(file_name)
+            todo.append(file_name)
+    print(f"共{len(pic_files)}张图片，其中{len(pic_files) - len(todo)}张已经处理过，跳过")
+
+    total = Metrics(config["METRICS"])
+    total.count("sources_skipped", len(pic_files) - len(todo))
+    progress = Progress(len(todo), config["PROGRESS_INTERVAL"])
+    start = time.perf_counter()
+
+    def finish(file_name: str, result: tuple):
+        samples, metrics = result
+        manifest.mark_done(file_name, hashes[file_name], config["OUTPUT_FORMAT"], samples)
+        total.merge(metrics)
+        total.count("sources_processed")
+        progress.update()
+
+    if config["WORKERS"] <= 1 and config["SPLIT_WINDOWED"]:
+        # 按窗口读取时打开图片只是建立映射，提前读取没有意义，还会把整张图片解码到内存中
+        for file_name in todo:
+            finish(file_name, process_source(file_name, config))
+    elif config["WORKERS"] <= 1:
+        # 只有一个进程时，在后台线程中提前读取之后的图片；多进程时各个进程的读取本来就是并行的
+        with PrefetchLoader(todo, config["DataSource"], get_decode_cache(config),
+                            config["PREFETCH"], config["LOADER_THREADS"]) as loader:
+            for file_name, data in total.timed(loader, "decode_wait"):
+                finish(file_name, process_source(file_name, config, data))
+                del data
+    else:
+        max_in_flight = max(config["MAX_IN_FLIGHT"], config["WORKERS"])
+        with ProcessPoolExecutor(config["WORKERS"], initializer=init_worker, initargs=(config,)) as pool:
+            tasks = iter(todo)
+            pending = dict()
+            while True:
+                # 补充任务直到达到上限
+                while len(pending) < max_in_flight:
+                    file_name = next(tasks, None)
+                    if file_name is None:
+                        break
+                    pending[pool.submit(process_source, file_name, config)] = file_name
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(pending.pop(future), future.result())
+    manifest.compact()
+    if total.enabled:
+        total.add_time("wall", time.perf_counter() - start)
+        total.update_memory()
+        print(total.report())
+        with open(path.join(config["DataTarget"], METRICS_NAME), mode="w", encoding="utf-8") as file:
+            json.dump(total.to_dict(), file, indent=2)
+    return [sample for file_name in pic_files for sample in manifest.get_samples(file_name)]
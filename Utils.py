@@ -1,4 +1,7 @@
+import io
 import json
+import os
+from itertools import chain
 from os import path
 
 import cv2
@@ -13,11 +16,361 @@ def get_mask(points: list, shape: tuple) -> numpy.ndarray:
     :return: 使用ndarray储存的三通道uint8图片
     """
     blank_mask = numpy.zeros((shape[0], shape[1]), dtype="uint8")
-    points = numpy.array(points, "int32")
-    mask = cv2.fillConvexPoly(blank_mask, points, (255, 255, 255))
+    points = numpy.array(points, "int32").reshape(-1, 2)
+    # fillConvexPoly会把凹多边形填错，所以使用fillPoly
+    mask = cv2.fillPoly(blank_mask, [points], 255)
     return mask
 
 
+def get_cropped_mask(points: list, shape: tuple) -> tuple:
+    """
+    与get_mask相同，但只在多边形的包围盒内生成mask，避免为每个多边形分配整张图片大小的内存
+    有多个多边形时应使用rasterize_polygons
+    :param points:多边形mask的点的信息
+    :param shape:图片的长与宽
+    :return: (包围盒左上角坐标(y, x), 包围盒内的uint8图片)
+    """
+    points = numpy.array(points, "int32").reshape(-1, 2)
+    if len(points) == 0:
+        return (0, 0), numpy.zeros((0, 0), dtype="uint8")
+    # 包围盒需要限制在图片范围内
+    x0 = max(int(points[:, 0].min()), 0)
+    y0 = max(int(points[:, 1].min()), 0)
+    x1 = min(int(points[:, 0].max()) + 1, shape[1])
+    y1 = min(int(points[:, 1].max()) + 1, shape[0])
+    if x1 <= x0 or y1 <= y0:
+        # 多边形完全在图片外
+        return (0, 0), numpy.zeros((0, 0), dtype="uint8")
+    blank_mask = numpy.zeros((y1 - y0, x1 - x0), dtype="uint8")
+    points = (points - numpy.array([x0, y0], "int32")).astype("int32")
+    mask = cv2.fillPoly(blank_mask, [points], 255)
+    return (y0, x0), mask
+
+
+def rasterize_polygons(polygons: list, shape: tuple, atlas_width: int = 1024) -> list:
+    """
+    一次栅格化所有多边形，结果与对每个多边形调用get_cropped_mask相同
+    所有多边形的包围盒按高度排列在一张图(atlas)上，只调用一次cv2.fillPoly，每个位图都是atlas的切片，
+    不需要为每个多边形单独分配内存；超出图片的多边形会越过自己的格子，仍然用get_cropped_mask单独栅格化
+    :param polygons: 多边形的列表，每个多边形为[[x, y], ...]
+    :param shape: 图片的(高度, 长度)
+    :param atlas_width: atlas的最小宽度
+    :return: 与polygons顺序相同的(包围盒左上角坐标(y, x), 包围盒内的uint8图片)列表
+    """
+    empty = ((0, 0), numpy.zeros((0, 0), dtype="uint8"))
+    results = [empty] * len(polygons)
+    if not polygons:
+        return results
+    points, starts, bounds = pack_polygons(polygons)
+    # 与get_cropped_mask相同，坐标截断为整数
+    pixels = points.astype("int32")
+    boxes = numpy.nan_to_num(bounds, posinf=0, neginf=-1).astype(int)
+    x0, y0 = numpy.maximum(boxes[:, 0], 0), numpy.maximum(boxes[:, 1], 0)
+    x1, y1 = numpy.minimum(boxes[:, 2] + 1, shape[1]), numpy.minimum(boxes[:, 3] + 1, shape[0])
+    valid = (x1 > x0) & (y1 > y0)
+    inside = valid & (boxes[:, 0] >= 0) & (boxes[:, 1] >= 0) & (boxes[:, 2] < shape[1]) & (boxes[:, 3] < shape[0])
+    for index in numpy.flatnonzero(valid & ~inside).tolist():
+        results[index] = get_cropped_mask(polygons[index], shape)
+
+    indexes = numpy.flatnonzero(inside)
+    if len(indexes) == 0:
+        return results
+    widths, heights = x1 - x0, y1 - y0
+    # 按高度从大到小一行一行地排列，行高为该行第一个格子的高度
+    indexes = indexes[numpy.argsort(-heights[indexes], kind="stable")].tolist()
+    widths, heights = widths.tolist(), heights.tolist()
+    atlas_width = max(atlas_width, max(widths[index] for index in indexes))
+    atlas_y, atlas_x = [0] * len(polygons), [0] * len(polygons)  # 每个格子在atlas中的位置
+    cur_y = cur_x = row_height = 0
+    for index in indexes:
+        if cur_x + widths[index] > atlas_width:
+            cur_y, cur_x, row_height = cur_y + row_height, 0, 0
+        row_height = row_height or heights[index]
+        atlas_y[index], atlas_x[index] = cur_y, cur_x
+        cur_x += widths[index]
+    atlas = numpy.zeros((cur_y + row_height, atlas_width), dtype="uint8")
+
+    # 把每个多边形平移到自己的格子中
+    shift = numpy.stack([numpy.array(atlas_x) - x0, numpy.array(atlas_y) - y0], axis=1).astype("int32")
+    pixels += numpy.repeat(shift, numpy.diff(starts), axis=0)
+    x0, y0, starts = x0.tolist(), y0.tolist(), starts.tolist()
+    cv2.fillPoly(atlas, [pixels[starts[index]:starts[index + 1]] for index in indexes], 255)
+    for index in indexes:
+        cur_y, cur_x = atlas_y[index], atlas_x[index]
+        results[index] = ((y0[index], x0[index]), atlas[cur_y:cur_y + heights[index], cur_x:cur_x + widths[index]])
+    return results
+
+
+def rasterize_label_map(polygons: list, shape: tuple, classes: list = None) -> tuple:
+    """
+    把所有多边形直接画到一张实例图上，不生成单独的mask
+    第i个多边形的值为i + 1，0为背景，重叠时后面的会覆盖前面的，每个像素与get_cropped_mask的结果相同
+    :param shape: 图片的(高度, 长度)
+    :param classes: 每个多边形的类别编号(1-255)，不为None时同时生成类别图
+    :return: (uint16的实例图, uint8的类别图)，classes为None时类别图为None
+    """
+    instances = numpy.zeros(shape[0:2], dtype="uint16")
+    class_map = numpy.zeros(shape[0:2], dtype="uint8") if classes is not None else None
+    if not polygons:
+        return instances, class_map
+    points, starts, _ = pack_polygons(polygons)
+    # 与get_cropped_mask相同，坐标截断为整数
+    pixels = points.astype("int32")
+    starts = starts.tolist()
+    for index in range(len(polygons)):
+        if starts[index + 1] == starts[index]:
+            continue
+        contour = [pixels[starts[index]:starts[index + 1]]]
+        cv2.fillPoly(instances, contour, index + 1)
+        if class_map is not None:
+            cv2.fillPoly(class_map, contour, classes[index])
+    return instances, class_map
+
+
+def pack_polygons(polygons: list) -> tuple:
+    """
+    把多个多边形的点合并到一个数组中，并一次算出所有多边形的包围盒
+    :param polygons: 多边形的列表，每个多边形为[[x, y], ...]
+    :return: (所有点(N, 2), 每个多边形的起点下标(长度为多边形数量+1), 每个多边形的(x最小值, y最小值, x最大值, y最大值))
+             没有点的多边形的包围盒为(inf, inf, -inf, -inf)
+    """
+    starts = numpy.zeros(len(polygons) + 1, dtype=int)
+    numpy.cumsum([len(i) for i in polygons], out=starts[1:])
+    if any(isinstance(i, numpy.ndarray) for i in polygons):
+        points = numpy.concatenate([numpy.asarray(i, dtype="float64").reshape(-1, 2) for i in polygons])
+    else:
+        # 从json读取的多边形，一次转换所有点比逐个转换快得多
+        points = numpy.array(list(chain.from_iterable(polygons)), dtype="float64").reshape(-1, 2)
+    bounds = numpy.empty((len(polygons), 4))
+    bounds[:, 0:2], bounds[:, 2:4] = numpy.inf, -numpy.inf
+    not_empty = starts[1:] > starts[:-1]
+    if not_empty.any():
+        bounds[not_empty, 0:2] = numpy.minimum.reduceat(points, starts[:-1][not_empty])
+        bounds[not_empty, 2:4] = numpy.maximum.reduceat(points, starts[:-1][not_empty])
+    return points, starts, bounds
+
+
+def clip_polygon(points, bounds: tuple) -> numpy.ndarray:
+    """
+    用Sutherland–Hodgman算法把多边形裁剪到矩形内
+    :param points: 多边形的点[[x, y], ...]
+    :param bounds: 矩形的(x_min, y_min, x_max, y_max)
+    :return: 裁剪后的点，形状为(N, 2)，多边形与矩形不相交时N为0
+    """
+    points = numpy.asarray(points, dtype="float64").reshape(-1, 2)
+    if len(points) == 0:
+        return points
+    low, high = points.min(axis=0), points.max(axis=0)
+    # 依次用矩形的四条边裁剪，(坐标轴, 边界, 保留大于边界的一侧)
+    # 交点都在原来的边上，所以没有越过某条边的多边形裁剪后也不会越过它，只需要用越过的边裁剪
+    sides = [(axis, bounds[axis], True) for axis in (0, 1) if low[axis] < bounds[axis]] + \
+            [(axis, bounds[axis + 2], False) for axis in (0, 1) if high[axis] > bounds[axis + 2]]
+    if not sides:
+        return points
+    cur = points.tolist()
+    for axis, limit, keep_greater in sides:
+        if not cur:
+            break
+        result = []
+        prev = cur[-1]
+        prev_inside = prev[axis] >= limit if keep_greater else prev[axis] <= limit
+        for point in cur:
+            inside = point[axis] >= limit if keep_greater else point[axis] <= limit
+            if inside != prev_inside:
+                # 这条边穿过了边界，加入交点
+                t = (limit - prev[axis]) / (point[axis] - prev[axis])
+                cross = [prev[0] + t * (point[0] - prev[0]), prev[1] + t * (point[1] - prev[1])]
+                cross[axis] = limit
+                result.append(cross)
+            if inside:
+                result.append(point)
+            prev, prev_inside = point, inside
+        cur = result
+    return numpy.array(cur, dtype="float64").reshape(-1, 2)
+
+
+def merge_masks(masks: list, shape: tuple) -> numpy.ndarray:
+    """
+    把多个mask合并成一张bool图
+    :param masks: (左上角坐标(y, x), 包围盒内的位图)的列表
+    :param shape: 合并后图片的(高度, 长度)
+    """
+    result = numpy.zeros(shape[0:2], dtype=bool)
+    for (y, x), bitmap in masks:
+        result[y:y + bitmap.shape[0], x:x + bitmap.shape[1]] |= bitmap == 255
+    return result
+
+
+def paste_with_mask(target: numpy.ndarray, source: numpy.ndarray, mask: numpy.ndarray, pos: tuple):
+    """
+    只把source中mask为True的像素贴到target的pos位置上，直接修改target
+    :param mask: 与source长宽相同的bool图
+    :param pos: source左上角在target中的位置(y, x)
+    """
+    region = target[pos[0]:pos[0] + source.shape[0], pos[1]:pos[1] + source.shape[1]]
+    if source.ndim == 3:
+        mask = mask[:, :, None]
+    numpy.copyto(region, source, where=mask)
+
+
+def get_bbox(mask: numpy.ndarray) -> tuple | None:
+    """bool图中为True的部分的包围盒(y0, x0, y1, x1)，全为False时返回None"""
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    return rows[0], cols[0], rows[-1] + 1, cols[-1] + 1
+
+
+def get_near_pairs(boxes: list, margin: int) -> tuple:
+    """
+    找出所有相距小于margin的包围盒对，即把右边和下边扩展margin后相交的包围盒
+    先按扩展后的范围把包围盒分到网格中，只比较同一格中的包围盒，时间和内存与包围盒数量近似成正比
+    :param boxes: (y0, x0, y1, x1)的列表
+    :return: (a的数组, b的数组)，a < b，同一对可能出现多次
+    """
+    array = numpy.array(boxes, dtype="int64").reshape(-1, 4)
+    y0, x0 = array[:, 0], array[:, 1]
+    y1, x1 = array[:, 2] + margin, array[:, 3] + margin
+    if len(array) < 2:
+        return numpy.zeros(0, dtype="int64"), numpy.zeros(0, dtype="int64")
+    # 格子与一般的包围盒差不多大，每一格中只有少数几个包围盒
+    cell = max(int(numpy.median(numpy.maximum(y1 - y0, x1 - x0))), 1)
+    rows0, cols0 = (y0 - y0.min()) // cell, (x0 - x0.min()) // cell
+    rows1, cols1 = (y1 - 1 - y0.min()) // cell, (x1 - 1 - x0.min()) // cell
+    # 每个包围盒在它覆盖的每一格中出现一次
+    widths = cols1 - cols0 + 1
+    counts = (rows1 - rows0 + 1) * widths
+    index = numpy.repeat(numpy.arange(len(array)), counts)
+    local = numpy.arange(len(index)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    keys = (rows0[index] + local // widths[index]) * (cols1.max() + 1) + cols0[index] + local % widths[index]
+    # 按格子排序后同一格的包围盒相邻，格内保持下标从小到大
+    order = numpy.argsort(keys, kind="stable")
+    keys, index = keys[order], index[order]
+    result_a, result_b = [], []
+    for distance in range(1, len(index)):
+        same = keys[distance:] == keys[:-distance]
+        if not same.any():
+            # 同一格的包围盒是连续的，距离更远的也不可能在同一格
+            break
+        a, b = index[:-distance][same], index[distance:][same]
+        near = (y0[a] < y1[b]) & (y0[b] < y1[a]) & (x0[a] < x1[b]) & (x0[b] < x1[a])
+        result_a.append(a[near])
+        result_b.append(b[near])
+    if not result_a:
+        return numpy.zeros(0, dtype="int64"), numpy.zeros(0, dtype="int64")
+    return numpy.concatenate(result_a), numpy.concatenate(result_b)
+
+
+def cluster_boxes(boxes: list, margin: int) -> list:
+    """
+    把相距小于margin的包围盒合并成组，直到任意两组的包围盒都相距不小于margin
+    :param boxes: (y0, x0, y1, x1)的列表
+    :return: (组的包围盒, 组内包围盒下标的列表)的列表，按组内最小的下标排序
+    """
+    groups = [(tuple(int(i) for i in box), [index]) for index, box in enumerate(boxes)]
+    while len(groups) > 1:
+        pairs = get_near_pairs([box for box, _ in groups], margin)
+        if len(pairs[0]) == 0:
+            break
+        # 并查集，合并所有相邻的组
+        parent = list(range(len(groups)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b in zip(pairs[0].tolist(), pairs[1].tolist()):
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+        merged = dict()
+        for index, (box, members) in enumerate(groups):
+            root = find(index)
+            if root not in merged:
+                merged[root] = (box, list(members))
+                continue
+            cur_box, cur_members = merged[root]
+            merged[root] = ((min(cur_box[0], box[0]), min(cur_box[1], box[1]),
+                             max(cur_box[2], box[2]), max(cur_box[3], box[3])), cur_members + members)
+        # 合并后的包围盒变大，可能又与其它组相邻，所以需要重复
+        groups = [(box, sorted(members)) for box, members in merged.values()]
+    return groups
+
+
+def seamless_paste(target: numpy.ndarray, source: numpy.ndarray, mask: numpy.ndarray, pos: tuple):
+    """
+    把source中mask为True的部分用泊松融合(MIXED_CLONE)贴到target的pos位置上，直接修改target
+    只在mask的包围盒内求解，与对整张图调用cv2.seamlessClone的结果相同
+    :param mask: 与source长宽相同的bool图
+    :param pos: source左上角在target中的位置(y, x)
+    """
+    bbox = get_bbox(mask)
+    if bbox is None:
+        return
+    y0, x0, y1, x1 = bbox
+    region = target[pos[0] + y0:pos[0] + y1, pos[1] + x0:pos[1] + x1]
+    # seamlessClone会把mask最外面一圈置0，所以先在外面补一圈，保证包围盒不变
+    cur_mask = numpy.pad(mask[y0:y1, x0:x1], 1).astype("uint8") * 255
+    cur_source = numpy.pad(source[y0:y1, x0:x1], ((1, 1), (1, 1), (0, 0)), mode="edge")
+    region[...] = cv2.seamlessClone(cur_source, numpy.ascontiguousarray(region), cur_mask,
+                                    ((x1 - x0) // 2, (y1 - y0) // 2), cv2.MIXED_CLONE)
+
+
+def feather_paste(target: numpy.ndarray, source: numpy.ndarray, mask: numpy.ndarray, pos: tuple, radius: int):
+    """
+    把source中mask为True的部分贴到target的pos位置上，mask内靠近边缘radius像素的部分逐渐透明，直接修改target
+    mask以外的像素不会被改变
+    :param mask: 与source长宽相同的bool图，应当已经比需要完整保留的部分大radius
+    """
+    bbox = get_bbox(mask)
+    if bbox is None:
+        return
+    y0, x0, y1, x1 = bbox
+    alpha = mask.astype("float32")
+    if radius > 0:
+        # 透明度随到mask边缘的距离线性增加，距离达到radius时完全不透明
+        distance = cv2.distanceTransform(numpy.pad(mask, 1).astype("uint8"), cv2.DIST_L2, 3)[1:-1, 1:-1]
+        alpha = numpy.minimum(distance / (radius + 1), 1)
+    region = target[pos[0] + y0:pos[0] + y1, pos[1] + x0:pos[1] + x1]
+    alpha = alpha[y0:y1, x0:x1, None]
+    region[...] = (source[y0:y1, x0:x1] * alpha + region * (1 - alpha) + 0.5).astype("uint8")
+
+
+def multiband_paste(target: numpy.ndarray, source: numpy.ndarray, mask: numpy.ndarray, pos: tuple,
+                    levels: int = 4):
+    """
+    用拉普拉斯金字塔把source中mask为True的部分贴到target的pos位置上，直接修改target
+    低频部分在较大范围内过渡，高频部分(细节)只在边缘附近过渡
+    :param mask: 与source长宽相同的bool图
+    :param levels: 金字塔的层数，source太小时会自动减少
+    """
+    if not mask.any():
+        return
+    region = target[pos[0]:pos[0] + source.shape[0], pos[1]:pos[1] + source.shape[1]]
+    cur_source = source.astype("float32")
+    cur_target = region.astype("float32")
+    cur_alpha = mask.astype("float32")
+    pyramid = []  # 每一层的(source的细节, target的细节, 透明度)
+    for _ in range(levels):
+        if min(cur_alpha.shape) < 4:
+            break
+        size = (cur_alpha.shape[1], cur_alpha.shape[0])
+        down_source, down_target = cv2.pyrDown(cur_source), cv2.pyrDown(cur_target)
+        pyramid.append((cur_source - cv2.pyrUp(down_source, dstsize=size),
+                        cur_target - cv2.pyrUp(down_target, dstsize=size),
+                        cur_alpha[:, :, None]))
+        cur_source, cur_target, cur_alpha = down_source, down_target, cv2.pyrDown(cur_alpha)
+    alpha = cur_alpha[:, :, None]
+    result = cur_source * alpha + cur_target * (1 - alpha)
+    for source_detail, target_detail, alpha in reversed(pyramid):
+        result = cv2.pyrUp(result, dstsize=(alpha.shape[1], alpha.shape[0]))
+        result += source_detail * alpha + target_detail * (1 - alpha)
+    region[...] = numpy.clip(result + 0.5, 0, 255).astype("uint8")
+
+
 def dump_mask(out_path: str, file_name: str, mask: numpy.ndarray):
     """
     指定输出路径和文件名来导出mask（不需要后缀名）
@@ -25,10 +378,47 @@ def dump_mask(out_path: str, file_name: str, mask: numpy.ndarray):
     cv2.imwrite(path.join(out_path, file_name + ".png"), mask)
 
 
+def get_json_name(file_name: str) -> str:
+    """图片对应的labelme json的文件名，即同名的.json文件"""
+    return path.splitext(file_name)[0] + ".json"
+
+
+def get_sample_name(file_name: str) -> str:
+    """
+    图片在输出中使用的名称，即去掉后缀名的文件名
+    子文件夹中的图片会把路径中的分隔符替换为_，例如 a/b.png 为 a_b
+    """
+    return path.splitext(file_name)[0].replace("\\", "/").replace("/", "_")
+
+
 def get_image(file_path: str) -> numpy.ndarray:
     return cv2.imread(file_path)
 
 
+def open_image(file_path: str, raw_path: str = None) -> numpy.ndarray:
+    """
+    以只读的内存映射打开图片，之后只有实际读取的区域才会加载到内存中
+    png、jpg无法只解码其中一部分，所以第一次打开时会完整解码一次，保存为未压缩的raw_path(.npy)后再映射
+    :param raw_path: 解码结果的保存位置，已经存在时直接映射；为None时不保存，返回完整解码的图片
+    """
+    if raw_path is not None:
+        try:
+            return numpy.load(raw_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError, EOFError):
+            # 不存在或者没有写完整
+            pass
+    image = get_image(file_path)
+    if raw_path is None or image is None:
+        return image
+    # 先写入临时文件再改名，防止其它进程读到没写完的文件
+    temp_path = raw_path + f".{os.getpid()}.tmp"
+    with open(temp_path, mode="wb") as file:
+        numpy.save(file, image)
+    os.replace(temp_path, raw_path)
+    del image
+    return numpy.load(raw_path, mmap_mode="r")
+
+
 def write_image(out_path: str, file_name: str, image: numpy.ndarray):
     """
     指定输出路径和文件名来导出图片（不需要后缀名）
@@ -36,6 +426,34 @@ def write_image(out_path: str, file_name: str, image: numpy.ndarray):
     cv2.imwrite(path.join(out_path, file_name + ".png"), image)
 
 
+def encode_png(image: numpy.ndarray, compression: int = 1) -> bytes:
+    """
+    把图片编码为PNG
+    :param compression: PNG的压缩等级，0-9
+    """
+    success, data = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not success:
+        raise IOError("PNG编码失败")
+    return data.tobytes()
+
+
+def encode_npz(arrays: dict, compressed: bool = True) -> bytes:
+    """把多个数组打包为npz文件的内容"""
+    buffer = io.BytesIO()
+    if compressed:
+        numpy.savez_compressed(buffer, **arrays)
+    else:
+        numpy.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def write_file(file_path: str, data: bytes) -> int:
+    """写入二进制文件，返回写入的字节数"""
+    with open(file_path, mode="wb") as file:
+        file.write(data)
+    return len(data)
+
+
 def read_masks_from_json(file_path: str) -> dict:
     """
     返回的dict结构如下
@@ -47,14 +465,22 @@ def read_masks_from_json(file_path: str) -> dict:
     :param file_path: 给出的json文件路径
     :return: 一个包含了该json所有mask的字典，其中mask包含了它的点集
     """
-    types = set()
     with open(file_path, mode="r") as file:
         json_file = json.loads(file.read())
+    return get_masks_from_json(json_file)
+
+
+def get_masks_from_json(json_file: dict) -> dict:
+    """
+    read_masks_from_json的解析部分
+    :param json_file: 已经读取的labelme json
+    """
+    types = set()
     for i in json_file["shapes"]:
         types.add(i["label"][0])  # 只有第一个字母代表类型
 
     result = dict()
-    for i in types:
+    for i in sorted(types):  # 固定类型的顺序，否则每个进程的顺序都可能不同
         result[i] = []
     polygons = json_file["shapes"]
     shape = (json_file["imageHeight"], json_file["imageWidth"])
@@ -0,0 +1,97 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Metrics import Metrics
+from Utils import write_file, encode_png
+
+
+class AsyncWriter:
+    """
+    在后台线程中编码并写入图片，主线程只负责提交
+    同时等待写入的图片数量超过max_pending时，提交会阻塞，防止内存无限增长
+    可以配合with使用，退出时会等待所有图片写完
+    """
+
+    def __init__(self, threads: int = 4, max_pending: int = 64, compression: int = 1, metrics=None):
+        """
+        :param threads: 编码和写入使用的线程数，为0时在提交的线程中直接写入
+        :param max_pending: 最多有多少张图片在等待写入
+        :param compression: PNG的压缩等级，0-9，越大文件越小但越慢
+        :param metrics: Metrics.Metrics，用于记录编码和写入的耗时，为None时不记录
+        """
+        self.compression = compression
+        self.metrics = metrics or Metrics()
+        self.pool = ThreadPoolExecutor(threads) if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.written = set()  # 已经提交过的路径，同一路径只写一次
+        self.lock = threading.Lock()
+        self.futures = []
+        self.bytes_written = 0
+        self.files_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write(self, file_path: str, data):
+        try:
+            if callable(data):
+                with self.metrics.timer("encode"):
+                    data = data()
+            with self.metrics.timer("write"):
+                size = write_file(file_path, data)
+            with self.lock:
+                self.bytes_written += size
+                self.files_written += 1
+        finally:
+            self.slots.release()
+
+    def write(self, file_path: str, data):
+        """
+        提交一个需要写入的文件
+        :param file_path: 完整的文件路径，包括后缀名
+        :param data: bytes，或者一个返回bytes的函数（会在后台线程中调用，用于把编码也放到后台）
+        """
+        with self.lock:
+            if file_path in self.written:
+                return
+            self.written.add(file_path)
+        # 等待的时间说明写入跟不上处理
+        with self.metrics.timer("writer_blocked"):
+            self.slots.acquire()
+        if self.pool is None:
+            self._write(file_path, data)
+            return
+        self.futures.append(self.pool.submit(self._write, file_path, data))
+        # 及时清理已经完成的任务，同时尽早抛出写入中的错误
+        if len(self.futures) > 256:
+            self._collect(wait=False)
+
+    def write_png(self, file_path: str, image):
+        """
+        提交一张需要写入的PNG图片
+        :param file_path: 完整的文件路径，包括后缀名
+        :param image: ndarray，或者一个返回ndarray的函数（会在后台线程中调用，用于延迟生成完整大小的mask）
+        """
+        self.write(file_path, lambda: encode_png(image() if callable(image) else image, self.compression))
+
+    def _collect(self, wait: bool):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            if wait or future.done():
+                future.result()
+            else:
+                self.futures.append(future)
+
+    def flush(self):
+        """等待所有已提交的图片写完，有写入失败的话抛出异常"""
+        self._collect(wait=True)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
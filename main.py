@@ -1,125 +1,161 @@
-import gc
+import json
 import os
-import random
-import re
 import time
 
-from DataAug import aug_data
-from DataObj import ImageData, Patch
+from DataAug import AUG_BACKENDS
+from DataObj import OUTPUT_FORMATS, PATCH_MODES, Patch
+from Index import select_vals, write_index
+from Loader import PrefetchLoader, scan_source
+from Manifest import Manifest
+from PatchArchive import EXTENSION, PatchArchiveWriter
+from Pipeline import get_decode_cache, run_aug
 
 # 配置部分
 # 注意：此处输入高和长的格式应为(高度, 长度)
 MODE = "AUG"  # 根据该项来输出 mode可为AUG,CreatePatch
 VAL_RATE = 1 / 10  # 随机产生的VAL列表应当占总文件的比例
+VAL_GROUP_BY_SOURCE = True  # 是否以源图片为单位选择VAL，这样同一张源图片的块不会同时出现在TRAIN和VAL中
 AUG = False  # 是否进行数据增强
+# IMGAUG: 使用imgaug进行增强
+# FUSED: 使用合并后的OpenCV实现，更快，参数的分布相同但随机结果与IMGAUG不同
+AUG_BACKEND = "IMGAUG"
+assert AUG_BACKEND in AUG_BACKENDS
+# 每个进程中同时运行的增强序列数，为0时依次运行，不会影响结果
+# WORKERS小于CPU核数(例如WORKERS为1)时可以设置为增强序列的数量4，让空闲的核同时运行其它序列
+AUG_THREADS = 0
 SPLIT = (384, 512)  # 将图片分割的大小，如果填写0或False则不进行分割
+SPLIT_STRIDE = None  # 分割时相邻两块的距离(高度, 长度)，小于SPLIT时会重叠，填写None则与SPLIT相同
+SPLIT_PAD = False  # 是否用0把边缘不足SPLIT大小的块补齐
+# 是否在AUG和SPLIT中保持多边形形式，SPLIT时直接裁剪多边形，导出(或贴图)时才栅格化
+# 物体很多时可以大幅减少内存占用，但块边缘的mask可能与先栅格化再切割的结果有1像素的差别
+POLYGON_MODE = False
+# 是否按窗口处理非常大的图片：每一块只从图片中读取自己的区域，只栅格化与自己相交的多边形，内存占用只与SPLIT的大小有关
+# 需要SPLIT，不能与AUG同时使用，SPLIT时总是裁剪多边形(与POLYGON_MODE相同)
+# png、jpg只能整张解码，所以必须设置CACHE_PATH，第一次解码后保存为未压缩的图片，之后都只读取需要的区域
+SPLIT_WINDOWED = False
+assert not SPLIT_WINDOWED or (SPLIT and not AUG)
 assert MODE in ("AUG", "CreatePatch")
 
 # PATCH 功能配置
 PATCH = True  # 是否进行贴图
-# TODO:动态切割Patch大小
-PATCH_SIZE = (128, 128)  # Patch的长宽
+# CreatePatch模式下切割Patch的方式
+# OBJECT: 以完整的h物体为中心裁剪出大小不固定的Patch，跳过被截断的物体
+# GRID: 按PATCH_SIZE的网格切割
+PATCH_EXTRACT = "OBJECT"
+assert PATCH_EXTRACT in ("OBJECT", "GRID")
+PATCH_SIZE = (128, 128)  # GRID模式下Patch的(高度, 长度)，OBJECT模式下Patch的最大(高度, 长度)
+PATCH_MARGIN = 4  # OBJECT模式下物体周围保留的背景宽度，相距小于它的物体会放在同一个Patch中
 PATCH_AMOUNT = 2  # 一张图上有几个Patch
-PATCH_PATH = "Patches\\"
+PATCH_PATH = "Patches\\"  # CreatePatch模式每次运行会在这里生成一个.patchpack文件
+PATCH_MMAP = True  # 是否用内存映射读取.patchpack，多进程时可以共享内存
+# NORMAL: 直接覆盖整个Patch的矩形区域
+# SEAMLESS: 只把h及其周围的区域用泊松融合贴上，最慢
+# FEATHER: 只把h及其周围的区域用边缘羽化的透明度混合贴上，最快
+# MULTIBAND: 只把h及其周围的区域用拉普拉斯金字塔融合贴上
 PATCH_MODE = "SEAMLESS"
-assert PATCH_MODE in ("NORMAL", "SEAMLESS")
+assert PATCH_MODE in PATCH_MODES
+PATCH_BLEND_RADIUS = 4  # 非NORMAL模式下h区域向外扩展的像素数，FEATHER模式下也是羽化的宽度
+PATCH_ALLOW_OVERLAP = False  # 是否允许Patch覆盖已有的物体和其它Patch
+PATCH_MAX_TRIES = 50  # 不允许覆盖时每个Patch最多尝试多少个随机位置，都不行则不贴该Patch
+
+# 并行配置
+WORKERS = os.cpu_count() or 1  # 处理图片的进程数，为1时在主进程中依次处理
+MAX_IN_FLIGHT = 2 * WORKERS  # 同时交给进程池的最大图片数，用于限制内存占用
+# 进程池中每个进程里OpenCV(仿射变换、模糊、无缝贴图、编码等)使用的线程数，进程已经占满所有核，所以默认为1
+WORKER_CV_THREADS = 1
+SEED = 0  # 随机种子，相同的种子和输入一定会得到相同的输出，与WORKERS无关
+
+# 导出配置
+# MASKS: 每个物体一个mask图片，即Target/名称/masks/[类型]编号.png
+# LABELMAP: 每张图片一个uint16实例图和一个uint8类别图，即Target/instances/名称.png和Target/classes/名称.png
+# NPZ: 每张图片一个压缩文件Target/名称.npz，包含图片和所有mask，可以用ImageData.create_from_npz读取
+OUTPUT_FORMAT = "MASKS"
+assert OUTPUT_FORMAT in OUTPUT_FORMATS
+CLASS_IDS = {"h": 1, "l": 2, "n": 3}  # LABELMAP中每个类型的类别编号，会保存到Target/classes.json
+WRITER_THREADS = 4  # 每个进程中用于编码和写入图片的线程数，为0时不使用后台线程
+WRITER_MAX_PENDING = 64  # 每个进程中最多有多少张图片在等待写入，超过时处理会暂停等待写入
+PNG_COMPRESSION = 1  # PNG压缩等级，0-9，越大文件越小但越慢
+
+# 缓存配置
+CACHE_PATH = None  # 解码后的图片和栅格化后的mask的缓存文件夹，例如"Cache\\"，填写None则不使用缓存
+CACHE_MAX_BYTES = 10 * 1024 ** 3  # 缓存的最大总大小，超过时删除最久没有使用的缓存
+# 没有缓存时SPLIT_WINDOWED会把整张图片解码到内存中，失去按窗口读取的意义
+assert not SPLIT_WINDOWED or CACHE_PATH
+
+# 统计配置
+METRICS = False  # 是否统计各阶段的耗时、数量和内存峰值，结果会输出并保存到Target/metrics.json
+PROGRESS_INTERVAL = 10  # 每隔多少秒输出一次进度和预计剩余时间，填写None则不输出
 
 # 基本数据源配置
-DataSource = "DataSource\\"  # 数据源
+DataSource = "DataSource\\"  # 数据源，其中的每张图片(jpg或png)都需要有同名的labelme json
+SOURCE_RECURSIVE = True  # 是否同时读取DataSource子文件夹中的图片，输出名称中的路径分隔符会被替换为_
+PREFETCH = 4  # 只有一个进程(WORKERS为1)或CreatePatch模式时，最多提前读取多少张图片，为0时不提前读取
+LOADER_THREADS = 2  # 提前读取图片使用的线程数
 DataTarget = "Target\\"  # 输出路径
 # 配置部分结束
 
-files = os.listdir(DataSource)
-print("读取文件成功")
-
-# 获取所有图片
-file: str
-picFiles = \
-    [file for file in files if re.fullmatch(r".*\.(jpg|png)$", file, re.I)]
-print("读取所有源图片成功：")
-print("\n".join(picFiles))
-
-# 从文件获取所有图像和mask
-data_file_list = []  # 需要导出的文件列表
-if MODE == "AUG":
-    # 创建目标输出文件夹
-    try:
-        os.mkdir(DataTarget)
-    except FileExistsError:
-        print("文件夹已存在，请删除Target文件夹，按任意键结束程序")
-        exit()
-    for i in picFiles:
-        print(f"\n\n开始处理图片: {i}")
-        cur_data: ImageData = ImageData.create_from_file(i, DataSource)
-        cur_data_list = [cur_data, ]
-
-        if AUG:
-            #  print("开始进行图像处理数据增强")
-            AUG_list = []
-            for j in cur_data_list:
-                AUG_list += aug_data(j)
-            cur_data_list = AUG_list
-
-        if SPLIT:
-            #  print("开始进行图像分割数据增强")
-            #  print("注意：如果使用了SPLIT的话只会输出被分割后的图片")
-            AUG_list = []
-            for j in cur_data_list:
-                AUG_list += j.split(SPLIT)
-            cur_data_list = AUG_list
-
-        if PATCH:
-            print("开始进行贴图数据增强")
-            AUG_list = []
-            # 初始化patches
-            patches = Patch.load_from_folder(PATCH_PATH)
-            if len(patches) < PATCH_AMOUNT:
-                print("有效Patch数量小于PATCH_AMOUNT，无法执行该项数据增强")
-                break
-            # 把Patch贴到每一张图上
-            # TODO：提供更高可自定义程度的贴图
-            # 如果新的贴图产生的ImageData中没有新增某一类型的细胞核，那么会导致重复，解决方法：只使用patched的图片
-            for data_file in cur_data_list:
-                cur_patches = random.sample(patches, PATCH_AMOUNT)
+config = dict(
+    AUG=AUG, AUG_BACKEND=AUG_BACKEND, AUG_THREADS=AUG_THREADS, SPLIT=SPLIT, SPLIT_STRIDE=SPLIT_STRIDE,
+    SPLIT_PAD=SPLIT_PAD, POLYGON_MODE=POLYGON_MODE, SPLIT_WINDOWED=SPLIT_WINDOWED,
+    PATCH=PATCH, PATCH_AMOUNT=PATCH_AMOUNT, PATCH_PATH=PATCH_PATH, PATCH_MODE=PATCH_MODE,
+    PATCH_BLEND_RADIUS=PATCH_BLEND_RADIUS, PATCH_ALLOW_OVERLAP=PATCH_ALLOW_OVERLAP,
+    PATCH_MAX_TRIES=PATCH_MAX_TRIES, PATCH_MMAP=PATCH_MMAP,
+    WORKERS=WORKERS, MAX_IN_FLIGHT=MAX_IN_FLIGHT, WORKER_CV_THREADS=WORKER_CV_THREADS, SEED=SEED,
+    OUTPUT_FORMAT=OUTPUT_FORMAT, CLASS_IDS=CLASS_IDS,
+    WRITER_THREADS=WRITER_THREADS, WRITER_MAX_PENDING=WRITER_MAX_PENDING, PNG_COMPRESSION=PNG_COMPRESSION,
+    CACHE_PATH=CACHE_PATH, CACHE_MAX_BYTES=CACHE_MAX_BYTES,
+    METRICS=METRICS, PROGRESS_INTERVAL=PROGRESS_INTERVAL,
+    DataSource=DataSource, DataTarget=DataTarget, PREFETCH=PREFETCH, LOADER_THREADS=LOADER_THREADS,
+)
+
+# 多进程在Windows下会重新导入本文件，所以实际的处理只能在这里进行
+if __name__ == "__main__":
+    # 获取所有有同名json的图片
+    picFiles = scan_source(DataSource, SOURCE_RECURSIVE)
+    print("读取所有源图片成功：")
+    print("\n".join(picFiles))
+
+    # 从文件获取所有图像和mask
+    if MODE == "AUG":
+        # 创建目标输出文件夹，已存在时根据其中的manifest只处理新增或改变的图片
+        os.makedirs(DataTarget, exist_ok=True)
+        samples = run_aug(picFiles, config, Manifest(DataTarget))  # 导出的所有样本，没有进行处理时为None
+        if samples is None:
+            print(f"没有进行任何处理，{DataTarget} 下已有的 index.jsonl 和 VALs.txt 保持不变")
+        else:
+            if OUTPUT_FORMAT == "LABELMAP":
+                with open(os.path.join(DataTarget, "classes.json"), mode="w") as classes_file:
+                    json.dump(CLASS_IDS, classes_file)
+
+            if int(len(samples) * VAL_RATE) < 1:
+                print("样本数量不足，或者VAL_RATE设置太小(该提示不会影响程序运行)")
+
+            print(f"转换全部成功，接下来进行随机选择VAL，你的VAL_RATE为{VAL_RATE}")
+            VALs = select_vals(samples, VAL_RATE, SEED, VAL_GROUP_BY_SOURCE)
+            # index.jsonl记录每个样本的源图片、经过的处理、导出的文件以及是否为VAL，VALs.txt每行一个VAL的名称
+            write_index(DataTarget, samples, VALs)
+            print(f"index.jsonl 和 VALs.txt 已经生成在了 {DataTarget} 下，其中VAL共{len(VALs)}个")
+            print("所有处理均已完成")
+
+
+    elif MODE == "CreatePatch":
+        try:
+            os.mkdir(PATCH_PATH)
+            print(f"已创建PATCH文件夹在:\n{PATCH_PATH}")
+        except FileExistsError:
+            print("PATCH文件夹已存在，直接向内追加")
+
+        time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+        with PatchArchiveWriter(os.path.join(PATCH_PATH, time + EXTENSION)) as writer, \
+                PrefetchLoader(picFiles, DataSource, get_decode_cache(config), PREFETCH, LOADER_THREADS) as loader:
+            for i, img in loader:
+                print(f"开始以该图片生成Patch: {i}")
+                if PATCH_EXTRACT == "OBJECT":
+                    cur_patches: list[Patch] = \
+                        Patch.create_from_objects(img, max_size=PATCH_SIZE, margin=PATCH_MARGIN)
+                else:
+                    cur_patches: list[Patch] = \
+                        Patch.create_from_image_data(img, patch_size=PATCH_SIZE)
                 for j in cur_patches:
-                    data_file = j.apply_to_image_data(data_file, mode=PATCH_MODE)
-                AUG_list.append(data_file)
-            cur_data_list = AUG_list
-
-        data_file_list += [j.name for j in cur_data_list]
-        for j in cur_data_list:
-            print(f"正在导出文件:\n{str(j)}")
-            j.dump_masks_and_image(DataTarget)
-        if len(data_file_list) % 10 == 0:
-            gc.collect()
-
-    if int(len(data_file_list) * VAL_RATE) < 1:
-        print("样本数量不足，或者VAL_RATE设置太小(该提示不会影响程序运行)")
-
-    print(f"转换全部成功，接下来进行随机选择VAL，你的VAL_RATE为{VAL_RATE}")
-    results = os.listdir(DataTarget)
-    VALs = random.sample(results, int(len(results) * VAL_RATE))
-    with open(os.path.join(DataTarget, "VALs.txt"), mode="w") as val_file:
-        val_file.write(str([i for i in VALs]))
-    print(f"VALs.txt 已经生成在了 {DataTarget} 下")
-    print("所有处理均已完成")
-
-
-elif MODE == "CreatePatch":
-    try:
-        os.mkdir(PATCH_PATH)
-        print(f"已创建PATCH文件夹在:\n{PATCH_PATH}")
-    except FileExistsError:
-        print("PATCH文件夹已存在，直接向内追加")
-
-    time = time.strftime("%Y-%m-%d", time.localtime())
-    cnt = 0
-    for i in picFiles:
-        print(f"开始以该图片生成Patch: {i}")
-        # noinspection PyTypeChecker
-        img: ImageData = ImageData.create_from_file(i, DataSource)
-        cur_patches: list[Patch] = \
-            Patch.create_from_image_data(img, patch_size=PATCH_SIZE)
-        for j in cur_patches:
-            cnt += 1
-            j.save_to_file(os.path.join(PATCH_PATH, time + f"_{cnt}.patch"))
+                    writer.write(j)
+            print(f"共生成了 {len(writer)} 个Patch")